@@ -0,0 +1,289 @@
+"""
+压测 mark02, mark03 和 wsgiref, 应用都是 mark01.WSGIHandler
+1.每个服务器用 mark05.Process 在单独的进程中启动, 压测客户端(asyncio)在当前进程, 互不抢 GIL
+2.场景: 并发数 x keep-alive 开关 x 响应大小, 另外 router 场景测 10/100/1000 条路由时的性能
+3.结果输出 JSON: req/s 和 p50/p99/p999 延迟(毫秒), 方便保存下来和以后的结果对比
+
+python benchmark.py --duration 3 --servers mark02,mark03 --output result.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import random
+import asyncio
+import argparse
+import platform
+from wsgiref.simple_server import make_server as wsgiref_make_server, WSGIRequestHandler
+
+import mark01
+import mark02
+import mark03
+import metrics
+from mark05 import Process
+
+
+SERVERS = ('mark02', 'mark02-threads', 'mark03', 'wsgiref')
+
+
+def make_app(routes=0):
+    """/payload/<size> 返回 size 字节, 另外加 routes 条 /r<n>/<id> 路由, 用来测路由匹配"""
+    payloads = {}
+
+    def payload(request, size):
+        size = int(size)
+        if size not in payloads:
+            payloads[size] = b'x' * size
+        return mark01.HttpResponse(payloads[size], content_type='application/octet-stream')
+
+    def item(request, item_id):
+        return mark01.HttpResponse(item_id)
+
+    urlpatterns = [(r'^/r%d/(?P<item_id>\d+)$' % index, item) for index in range(routes)]
+    urlpatterns.append((r'^/payload/(?P<size>\d+)$', payload))
+    return mark01.WSGIHandler(middleware=[], urlpatterns=urlpatterns)
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):  # wsgiref 默认每个请求往 stderr 打一行
+        pass
+
+
+def serve(server, port, routes, metrics_enabled):
+    """在子进程中运行, 直到被 terminate"""
+    metrics.set_enabled(metrics_enabled)
+    app = make_app(routes)
+    address = ('127.0.0.1', port)
+    if server == 'mark02':
+        httpd = mark02.make_server(address, app)
+    elif server == 'mark02-threads':
+        httpd = mark02.make_server(address, app, threads=16)
+    elif server == 'mark03':
+        httpd = mark03.make_server(address, app, backlog=1024)
+    elif server == 'wsgiref':
+        httpd = wsgiref_make_server('127.0.0.1', port, app, handler_class=QuietHandler)
+    else:
+        raise ValueError('unknown server %r' % server)
+    httpd.serve_forever()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(server, routes=0, metrics_enabled=True, timeout=10):
+    port = free_port()
+    process = Process(target=serve, args=(server, port, routes, metrics_enabled))
+    process.start()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            if time.monotonic() > deadline or not process.is_alive():
+                stop_server(process)
+                raise RuntimeError('%s did not start' % server)
+            time.sleep(0.05)
+
+
+def stop_server(process):
+    process.terminate()
+    process.join(5)
+    if process.is_alive():
+        process.kill()
+        process.join()
+
+
+async def read_response(reader):
+    """读一个完整响应, 返回 (状态码, 服务器是否会关闭连接)"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ', 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    close = headers.get('connection', '').lower() == 'close' or lines[0].startswith('HTTP/1.0')
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if not size:
+                break
+    else:
+        await reader.read()
+        close = True
+    return status, close
+
+
+async def client(port, paths, keepalive, deadline, latencies, errors):
+    reader = writer = None
+    connection = 'keep-alive' if keepalive else 'close'
+    while time.perf_counter() < deadline:
+        path = random.choice(paths)
+        request = ('GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: %s\r\n\r\n'
+                   % (path, connection)).encode('latin-1')
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request)
+            status, close = await read_response(reader)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            errors.append(1)
+            close = True
+            status = None
+        if status is not None:
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+        if close or not keepalive:
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def drive(port, paths, concurrency, keepalive, duration):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(client(port, paths, keepalive, deadline, latencies, errors)
+                           for _ in range(concurrency)))
+    return latencies, errors
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return round(sorted_values[index] * 1000, 3)
+
+
+def run_case(port, paths, concurrency, keepalive, duration, warmup):
+    if warmup:
+        asyncio.run(drive(port, paths, concurrency, keepalive, warmup))
+    started = time.perf_counter()
+    latencies, errors = asyncio.run(drive(port, paths, concurrency, keepalive, duration))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'duration': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': percentile(latencies, 0.50),
+        'p99_ms': percentile(latencies, 0.99),
+        'p999_ms': percentile(latencies, 0.999),
+    }
+
+
+def bench_servers(args):
+    results = []
+    for server in args.servers:
+        process, port = start_server(server, metrics_enabled=not args.no_metrics)
+        try:
+            for payload in args.payloads:
+                for keepalive in args.keepalive:
+                    for concurrency in args.concurrency:
+                        result = run_case(port, ['/payload/%d' % payload], concurrency, keepalive,
+                                          args.duration, args.warmup)
+                        result.update(scenario='server', server=server, concurrency=concurrency,
+                                      keepalive=keepalive, payload=payload)
+                        log(result)
+                        results.append(result)
+        finally:
+            stop_server(process)
+    return results
+
+
+def bench_router(args):
+    """只有最后一条路由会匹配, id 随机, 路由结果缓存基本不命中, 测的是路由匹配本身"""
+    results = []
+    for routes in args.routes:
+        process, port = start_server(args.router_server, routes, metrics_enabled=not args.no_metrics)
+        try:
+            paths = ['/r%d/%d' % (routes - 1, random.randrange(10 ** 9)) for _ in range(10000)]
+            for keepalive in args.keepalive:
+                result = run_case(port, paths, args.router_concurrency, keepalive, args.duration, args.warmup)
+                result.update(scenario='router', server=args.router_server, routes=routes,
+                              concurrency=args.router_concurrency, keepalive=keepalive)
+                log(result)
+                results.append(result)
+        finally:
+            stop_server(process)
+    return results
+
+
+def log(result):
+    print(json.dumps(result, sort_keys=True), file=sys.stderr)
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--servers', default=','.join(SERVERS),
+                        type=lambda value: [item for item in value.split(',') if item])
+    parser.add_argument('--concurrency', default=[1, 10, 50], type=int_list)
+    parser.add_argument('--payloads', default=[64, 4096, 65536], type=int_list)
+    parser.add_argument('--keepalive', default='both', choices=('on', 'off', 'both'))
+    parser.add_argument('--routes', default=[10, 100, 1000], type=int_list)
+    parser.add_argument('--router-server', default='mark03', choices=SERVERS)
+    parser.add_argument('--router-concurrency', default=10, type=int)
+    parser.add_argument('--duration', default=3.0, type=float, help='seconds per case')
+    parser.add_argument('--warmup', default=0.5, type=float, help='seconds of warmup per case')
+    parser.add_argument('--scenarios', default='server,router',
+                        type=lambda value: [item for item in value.split(',') if item])
+    parser.add_argument('--no-metrics', action='store_true', help='disable metrics in the servers')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+    args.keepalive = {'on': [True], 'off': [False], 'both': [True, False]}[args.keepalive]
+    unknown = set(args.servers) - set(SERVERS)
+    if unknown:
+        parser.error('unknown servers: %s' % ', '.join(sorted(unknown)))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    results = []
+    if 'server' in args.scenarios:
+        results += bench_servers(args)
+    if 'router' in args.scenarios:
+        results += bench_router(args)
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'metrics': not args.no_metrics,
+            'duration': args.duration,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return report
+
+
+if __name__ == '__main__':
+    main()
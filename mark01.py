@@ -1,12 +1,25 @@
-import cgi
+import os
 import re
 import json
+import time
+import asyncio
+import inspect
+import mimetypes
+import tempfile
+import threading
 import importlib
-from io import StringIO
+from io import BytesIO
+from collections import OrderedDict
+from functools import cached_property
+from http import HTTPStatus
+from http.cookies import SimpleCookie, CookieError
+from urllib.parse import parse_qsl
 from wsgiref.simple_server import make_server, demo_app
 
+import metrics
 
-responses = {200: "OK"}
+
+responses = {status.value: status.phrase for status in HTTPStatus}
 
 
 def import_string(dotted_path):
@@ -15,9 +28,146 @@ def import_string(dotted_path):
     return getattr(module, class_name)
 
 
+_loop_local = threading.local()
+
+
+def run_coroutine(coro):
+    """在当前线程自己的事件循环里把协程跑完, 让同步调用链也能调用 async 的 view/中间件"""
+    loop = getattr(_loop_local, 'loop', None)
+    if loop is None:
+        loop = _loop_local.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coro)
+
+
+def adapt_handler(handler, handler_is_async, want_async):
+    """同步/异步 handler 互相转换, 只在中间件链构建时调用一次"""
+    if handler_is_async == want_async:
+        return handler
+    if want_async:
+        async def async_handler(request):  # 同步部分放到线程池里, 不阻塞外层事件循环
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, handler, request)
+        return async_handler
+
+    def sync_handler(request):
+        return run_coroutine(handler(request))
+    return sync_handler
+
+
+def hook_middleware(mw_instance, get_response):
+    """
+    把只有 process_request/process_response 钩子的老式中间件包装成链上的一环,
+    process_request 返回 HttpResponse 时直接短路, 不再往里调用
+    """
+    process_request = getattr(mw_instance, 'process_request', None)
+    process_response = getattr(mw_instance, 'process_response', None)
+
+    def middleware(request):
+        response = None
+        if process_request is not None:
+            result = process_request(request)
+            if isinstance(result, HttpResponseBase):
+                response = result
+            elif result is not None:
+                request = result
+        if response is None:
+            response = get_response(request)
+        if process_response is not None:
+            response = process_response(request, response)
+        return response
+    return middleware
+
+
+_header_param_re = re.compile(r';(?=(?:[^"]*"[^"]*")*[^"]*$)')
+
+
+def parse_header(line):
+    """
+    解析 Content-Type / Content-Disposition 这类带参数的头, 代替 cgi.parse_header
+    'form-data; name="a"; filename="b.txt"' -> ('form-data', {'name': 'a', 'filename': 'b.txt'})
+    """
+    parts = _header_param_re.split(line)
+    key = parts[0].strip().lower()
+    pdict = {}
+    for part in parts[1:]:
+        name, sep, value = part.partition('=')
+        if not sep:
+            continue
+        name, value = name.strip().lower(), value.strip()
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            value = value[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+        pdict[name] = value
+    return key, pdict
+
+
+class LRUCache:
+    """
+    线程安全的 LRU 缓存, 条目数超过 maxsize 或者总大小超过 max_bytes 时淘汰最久未使用的条目,
+    每个条目可以单独设置过期时间 timeout(秒)
+    """
+    def __init__(self, maxsize=1024, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.total_size = 0
+        self._data = OrderedDict()  # {key: (value, 过期时间, 大小)}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires, size = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                self.total_size -= size
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None, size=0):
+        expires = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.total_size -= old[2]
+            self._data[key] = (value, expires, size)
+            self.total_size += size
+            while len(self._data) > self.maxsize or (
+                    self.max_bytes is not None and self.total_size > self.max_bytes and self._data):
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self.total_size -= evicted_size
+
+    def delete(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.total_size -= old[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.total_size = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+class Resolver404(Exception):
+    pass
+
+
+class MethodNotAllowed(Exception):
+    def __init__(self, allowed):
+        super().__init__(allowed)
+        self.allowed = allowed
+
+
 class RegexPattern:
-    def __init__(self, regex):
+    def __init__(self, regex, view=None, methods=None):
         self.regex = re.compile(regex)
+        self.view = view
+        self.methods = frozenset(m.upper() for m in methods) if methods else None
 
     def match(self, path):
         match = self.regex.search(path)
@@ -25,59 +175,250 @@ class RegexPattern:
             return True
         return False
 
+    def allows(self, method):
+        return self.methods is None or method in self.methods
+
+
+# 命名分组和命名反向引用, 合并成一个大正则时需要给它们加上路由前缀, 防止重名
+_GROUP_NAME_RE = re.compile(r'\(\?P([<=])(\w+)')
+# 数字反向引用 \1 和条件分组 (?(1)...), 合并后分组序号变了, 这样的路由不能合并
+_NUMBERED_REF_RE = re.compile(r'(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(')
+
+
+def _is_anchored(regex):
+    """以 ^ 开头且顶层没有 |, 这样的正则 search 和 match 结果一样, 可以合并后用 match 匹配"""
+    if not regex.startswith('^'):
+        return False
+    depth, in_class, escaped = 0, False, False
+    for char in regex:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return False
+    return True
+
+
+class Router:
+    """
+    路由系统, 加载时把 urlpatterns 中连续的锚定(^ 开头)路由合并成一个交替正则,
+    一次 match 就能找到第一个匹配的路由, 并带上命名参数; 没有锚定的路由保持 search 语义, 单独匹配;
+    命中的结果放进 LRU 缓存, 热点路径直接跳过匹配, 404/405 放在另一个小的缓存里, 不会挤掉热点路径
+    """
+    cache_size = 1024
+    miss_cache_size = 256
+
+    def __init__(self, urlpatterns, cache_size=None):
+        self.patterns = []
+        for url in urlpatterns:
+            regex, view = url[0], url[1]
+            methods = url[2] if len(url) > 2 else None
+            self.patterns.append(RegexPattern(regex, view, methods))
+        self._plan = None
+        self._cache = LRUCache(cache_size or self.cache_size)
+        self._miss_cache = LRUCache(self.miss_cache_size)
+
+    def _compile(self):
+        """
+        返回按路由顺序排列的匹配计划 [(regex, {分组序号: (路由序号, pattern, 参数名映射)})],
+        regex 为 None 时表示单独 search 的路由, 第二项是 (路由序号, pattern)
+        """
+        plan, run = [], []
+        for index, pattern in enumerate(self.patterns):
+            if _is_anchored(pattern.regex.pattern) and not _NUMBERED_REF_RE.search(pattern.regex.pattern):
+                run.append((index, pattern))
+                continue
+            plan.extend(self._compile_run(run))
+            run = []
+            plan.append((None, (index, pattern)))
+        plan.extend(self._compile_run(run))
+        return plan
+
+    @staticmethod
+    def _compile_run(run):
+        if not run:
+            return []
+        alternatives = []
+        for index, pattern in run:
+            prefix = '_r%d_' % index
+            body = _GROUP_NAME_RE.sub(lambda m: '(?P%s%s%s' % (m.group(1), prefix, m.group(2)),
+                                      pattern.regex.pattern)
+            # 空的标记分组放在末尾, 它最后结束, match.lastindex 就是它; 分支以字面量开头, re 可以快速跳过不匹配的分支
+            alternatives.append('(?:%s(?P<_r%d>))' % (body, index))
+        try:
+            regex = re.compile('|'.join(alternatives))
+        except re.error:  # 带全局 flag 等无法合并的正则, 退回逐个匹配
+            return [(None, item) for item in run]
+        targets = {}
+        for index, pattern in run:
+            prefix = '_r%d_' % index
+            params = {prefix + name: name for name in pattern.regex.groupindex}
+            targets[regex.groupindex['_r%d' % index]] = (index, pattern, params)
+        return [(regex, targets)]
+
+    def _match(self, path):
+        """按顺序找第一个匹配 path 的路由(不管方法), 返回 (路由序号, pattern, kwargs) 或 None"""
+        if self._plan is None:
+            self._plan = self._compile()
+        for regex, targets in self._plan:
+            if regex is None:
+                index, pattern = targets
+                match = pattern.regex.search(path)
+                if match:
+                    return index, pattern, match.groupdict()
+                continue
+            match = regex.match(path)
+            if match is not None:
+                index, pattern, params = targets[match.lastindex]
+                return index, pattern, {name: match.group(group) for group, name in params.items()}
+        return None
+
+    def _resolve(self, method, path):
+        """返回 (view, kwargs, 路由正则); 404 时为 (None, None, None), 405 时为 (None, 允许的方法, None)"""
+        found = self._match(path)
+        if found is None:
+            return None, None, None
+        index, pattern, kwargs = found
+        if pattern.allows(method):
+            return pattern.view, kwargs, pattern.regex.pattern
+        # 第一个匹配的路由不允许这个方法, 从它后面继续按顺序找, 顺便收集允许的方法
+        allowed = set(pattern.methods)
+        for pattern in self.patterns[index + 1:]:
+            match = pattern.regex.search(path)
+            if match is None:
+                continue
+            if pattern.allows(method):
+                return pattern.view, match.groupdict(), pattern.regex.pattern
+            allowed |= pattern.methods
+        return None, sorted(allowed), None
+
+    def resolve(self, method, path):
+        """返回 (view, kwargs), 找不到抛 Resolver404, 方法不允许抛 MethodNotAllowed"""
+        return self.resolve_route(method, path)[:2]
+
+    def resolve_route(self, method, path):
+        """同 resolve, 多返回匹配到的路由正则, 用作监控指标的标签"""
+        key = (method, path)
+        result = self._cache.get(key) or self._miss_cache.get(key)
+        if result is None:
+            result = self._resolve(method, path)
+            (self._cache if result[0] is not None else self._miss_cache).set(key, result)
+        view, kwargs, route = result
+        if view is None:
+            if kwargs is None:
+                raise Resolver404(path)
+            raise MethodNotAllowed(kwargs)
+        return result
+
 
 class BaseHandler:
-    _request_middleware = None
     _view_middleware = None
     _template_response_middleware = None
-    _response_middleware = None
     _exception_middleware = None
     _middleware_chain = None
+    middleware_instances = None  # {中间件路径: 实例}, 方便读取中间件的统计数据
 
     _router = None  # 路由系统
 
     def load_middleware(self, middleware_list):
-        """load settings.middleware list"""
-        self._request_middleware = []
-        # self._view_middleware = []
-        # self._template_response_middleware = []
-        self._response_middleware = []
-        # self._exception_middleware = []
-
-        for middleware_path in middleware_list:
-            mw_instance = import_string(middleware_path)
-
-            if hasattr(mw_instance, 'process_request'):
-                self._request_middleware.append(mw_instance.process_request)
-            if hasattr(mw_instance, 'process_response'):
-                self._response_middleware.append(mw_instance.process_response)
+        """
+        load settings.middleware list
+        启动时把中间件实例化一次, 由内向外组装成洋葱式的调用链存入 _middleware_chain,
+        中间件有两种写法:
+        1.定义了 __call__ 的类, 以 middleware(get_response) 实例化, __call__ 可以是 async def
+        2.只有 process_request/process_response 钩子的类, 无参实例化
+        两种都可以再提供 process_view 和 process_exception 钩子
+        """
+        self._view_middleware = []
+        self._template_response_middleware = []
+        self._exception_middleware = []
+        self.middleware_instances = {}
+
+        handler = self._get_response
+        handler_is_async = False
+        for middleware_path in reversed(middleware_list):
+            middleware = import_string(middleware_path)
+
+            if inspect.isfunction(getattr(middleware, '__call__', None)):
+                middleware_is_async = asyncio.iscoroutinefunction(middleware.__call__)
+                mw_instance = middleware(adapt_handler(handler, handler_is_async, middleware_is_async))
+                handler, handler_is_async = mw_instance, middleware_is_async
+            else:
+                mw_instance = middleware()
+                handler = hook_middleware(mw_instance, adapt_handler(handler, handler_is_async, False))
+                handler_is_async = False
+            self.middleware_instances[middleware_path] = mw_instance
+            if metrics.ENABLED:
+                handler = metrics.timed_handler(handler, middleware_path, handler_is_async)
+
+            if hasattr(mw_instance, 'process_view'):
+                self._view_middleware.insert(0, mw_instance.process_view)
+            if hasattr(mw_instance, 'process_exception'):
+                self._exception_middleware.append(mw_instance.process_exception)
+
+        self._middleware_chain = adapt_handler(handler, handler_is_async, False)
 
     def load_urls(self, urlpatterns):
-        self._router = {RegexPattern(i[0]): i[1] for i in urlpatterns}
+        """urlpatterns: [(regex, view), (regex, view, ['GET', 'POST']), ...]"""
+        self._router = Router(urlpatterns)
 
     def get_response(self, request):
-        response = None
-        # 1.首先处理中间件 middleware
-        for req in self._request_middleware:
-            request = req(req, request)
-
-        # 2.然后处理view请求
-        for regex, view in self._router.items():
-            if regex.match(request.path):
-                response = view(request)
-
-        # 3.最后处理response
-        for resp in self._response_middleware:
-            response = resp(resp, request, response)
+        return self._middleware_chain(request)
+
+    def _get_response(self, request):
+        """中间件链最里层: 路由解析, process_view, 调用 view, 出错交给 process_exception"""
+        try:
+            view, kwargs, request.route = self._router.resolve_route(request.method, request.path)
+        except Resolver404:
+            return HttpResponse('Not Found', status=404)
+        except MethodNotAllowed as error:
+            response = HttpResponse('Method Not Allowed', status=405)
+            response['Allow'] = ', '.join(error.allowed)
+            return response
+
+        for process_view in self._view_middleware:
+            response = process_view(request, view, kwargs)
+            if response is not None:
+                return response
+
+        try:
+            response = view(request, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = run_coroutine(response)
+        except Exception as error:
+            response = self.process_exception_by_middleware(error, request)
+            if response is None:
+                raise
         return response
 
+    def process_exception_by_middleware(self, exception, request):
+        for process_exception in self._exception_middleware:
+            response = process_exception(request, exception)
+            if response is not None:
+                return response
+        return None
 
-class HttpResponse:
+
+_charset_from_content_type_re = re.compile(r';\s*charset=(?P<charset>[^\s;]+)', re.I)
+
+
+class HttpResponseBase:
+    """响应的公共部分: 状态码, 响应头, 编码; body 的存放方式交给子类"""
     streaming = False
     status_code = 200
 
-    def __init__(self, content=b'', content_type=None, status=None, reason=None, charset=None):
-        self.content = content
+    def __init__(self, content_type=None, status=None, reason=None, charset=None):
+        self._headers = {}  # {小写头名: (头名, 值)}
+        self._closable_objects = []
         if status is not None:
             try:
                 self.status_code = int(status)
@@ -89,22 +430,368 @@ class HttpResponse:
         self._reason_phrase = reason
         self._charset = charset
         if content_type is None:
-            content_type = 'text/plain; charset=utf-8'
-        self.content_type = content_type
+            content_type = 'text/plain; charset=%s' % self.charset
+        self['Content-Type'] = content_type
 
+    @property
     def reason_phrase(self):
         if self._reason_phrase is not None:
             return self._reason_phrase
         return responses.get(self.status_code, 'Unknown Status Code')
 
+    @property
+    def charset(self):
+        if self._charset is not None:
+            return self._charset
+        content_type = self._headers.get('content-type', ('', ''))[1]
+        matched = _charset_from_content_type_re.search(content_type)
+        if matched:
+            return matched.group('charset').replace('"', '')
+        return 'utf-8'
+
+    @property
+    def content_type(self):
+        return self['Content-Type']
+
+    def __setitem__(self, header, value):
+        self._headers[header.lower()] = (header, str(value))
+
+    def __getitem__(self, header):
+        return self._headers[header.lower()][1]
+
+    def __delitem__(self, header):
+        self._headers.pop(header.lower(), None)
+
+    def has_header(self, header):
+        return header.lower() in self._headers
+
+    __contains__ = has_header
+
+    def get(self, header, alternate=None):
+        return self._headers.get(header.lower(), (None, alternate))[1]
+
+    def items(self):
+        return self._headers.values()
+
+    def make_bytes(self, value):
+        """str 按 charset 编码, bytes 原样返回, 不做多余的拷贝"""
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, (bytearray, memoryview)):
+            return bytes(value)
+        if isinstance(value, str):
+            return value.encode(self.charset)
+        return str(value).encode(self.charset)
+
+    def close(self):
+        """WSGI 服务器在发送完成后调用, 关闭文件等资源"""
+        for closable in self._closable_objects:
+            try:
+                closable.close()
+            except Exception:
+                pass
+        self._closable_objects = []
+
+
+class HttpResponse(HttpResponseBase):
+    """body 一次性放在内存里的响应, content 始终以 bytes 保存"""
+    def __init__(self, content=b'', content_type=None, status=None, reason=None, charset=None):
+        super().__init__(content_type, status, reason, charset)
+        self.content = content
+
+    @property
+    def content(self):
+        return self._container
+
+    @content.setter
+    def content(self, value):
+        if isinstance(value, (bytes, str, bytearray, memoryview)) or not hasattr(value, '__iter__'):
+            self._container = self.make_bytes(value)
+        else:  # 可迭代对象一次性合并
+            self._container = b''.join(map(self.make_bytes, value))
+            if hasattr(value, 'close'):
+                value.close()
+
+    def render(self):
+        return [self._container]
+
+
+class StreamingHttpResponse(HttpResponseBase):
+    """body 由迭代器/生成器逐块产生的响应, 不会整体缓冲在内存里"""
+    streaming = True
+
+    def __init__(self, streaming_content=(), content_type=None, status=None, reason=None, charset=None):
+        super().__init__(content_type, status, reason, charset)
+        self.streaming_content = streaming_content
+
+    @property
+    def content(self):
+        raise AttributeError('This %s instance has no `content` attribute. '
+                             'Use `streaming_content` instead.' % self.__class__.__name__)
+
+    @property
+    def streaming_content(self):
+        return map(self.make_bytes, self._iterator)
+
+    @streaming_content.setter
+    def streaming_content(self, value):
+        self._iterator = iter(value)
+        if hasattr(value, 'close'):
+            self._closable_objects.append(value)
+
+    def __iter__(self):
+        return self.streaming_content
+
     def render(self):
-        stdout = StringIO()
-        print(self.content, file=stdout)
-        return [stdout.getvalue().encode("utf-8")]
+        # 返回自身, WSGI 服务器迭代发送, 结束后调用 close()
+        return self
+
+
+class FileResponse(StreamingHttpResponse):
+    """
+    文件响应, 服务器提供 wsgi.file_wrapper 时交给它发送(可以走 sendfile),
+    否则按 block_size 分块读取
+    """
+    block_size = 4096 * 16
+
+    def __init__(self, filelike, content_type=None, status=None, reason=None, charset=None, filename=None):
+        filename = filename or os.path.basename(getattr(filelike, 'name', '') or '')
+        if content_type is None:
+            content_type = mimetypes.guess_type(filename)[0] if filename else None
+            content_type = content_type or 'application/octet-stream'
+        self.file_to_stream = filelike
+        super().__init__(iter(lambda: filelike.read(self.block_size), b''),
+                         content_type, status, reason, charset)
+        self._closable_objects.append(filelike)
+        size = self._file_size(filelike)
+        if size is not None:
+            self['Content-Length'] = size
+
+    @staticmethod
+    def _file_size(filelike):
+        try:
+            return os.fstat(filelike.fileno()).st_size - filelike.tell()
+        except (AttributeError, OSError, ValueError):
+            pass
+        try:  # BytesIO 之类没有 fileno 的对象
+            position = filelike.tell()
+            size = filelike.seek(0, os.SEEK_END) - position
+            filelike.seek(position)
+            return size
+        except (AttributeError, OSError, ValueError):
+            return None
+
+
+class QueryDict(dict):
+    """一个 key 可以对应多个值, request[key] 取最后一个, getlist 取全部"""
+    def __init__(self, query_string='', encoding='utf-8'):
+        super().__init__()
+        if isinstance(query_string, bytes):
+            query_string = query_string.decode(encoding, 'replace')
+        for key, value in parse_qsl(query_string, keep_blank_values=True, encoding=encoding):
+            self.appendlist(key, value)
+
+    def __getitem__(self, key):
+        return super().__getitem__(key)[-1]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def getlist(self, key):
+        return list(super().get(key, ()))
+
+    def appendlist(self, key, value):
+        self.setdefault(key, []).append(value)
+
+    def items(self):
+        return [(key, values[-1]) for key, values in super().items()]
+
+
+class HttpHeaders(dict):
+    """从 environ 中取出请求头, 头名统一小写, 查找时大小写不敏感"""
+    UNPREFIXED_HEADERS = {'CONTENT_TYPE', 'CONTENT_LENGTH'}
+
+    def __init__(self, environ):
+        super().__init__()
+        for key, value in environ.items():
+            if key.startswith('HTTP_'):
+                key = key[5:]
+            elif key not in self.UNPREFIXED_HEADERS:
+                continue
+            super().__setitem__(key.replace('_', '-').lower(), value)
+
+    def __getitem__(self, key):
+        return super().__getitem__(key.lower())
+
+    def __contains__(self, key):
+        return super().__contains__(key.lower())
+
+    def get(self, key, default=None):
+        return super().get(key.lower(), default)
+
+
+class RawPostDataException(Exception):
+    """multipart 已经按流读取过 wsgi.input, 无法再访问 body"""
+
+
+class MultiPartParserError(ValueError):
+    pass
+
+
+class UploadedFile:
+    """上传的文件, 内容保存在 SpooledTemporaryFile 中, 超过阈值才落盘"""
+    def __init__(self, file, name, content_type, size, charset=None):
+        self.file = file
+        self.name = name
+        self.content_type = content_type
+        self.size = size
+        self.charset = charset
+
+    def read(self, *args):
+        return self.file.read(*args)
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def chunks(self, chunk_size=64 * 1024):
+        self.file.seek(0)
+        return iter(lambda: self.file.read(chunk_size), b'')
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return '<UploadedFile: %s (%s)>' % (self.name, self.content_type)
+
+
+class MultiPartParser:
+    """
+    流式解析 multipart/form-data, 每次最多读 chunk_size 字节,
+    文件内容写入 SpooledTemporaryFile(小于 max_memory_size 时在内存, 超过后落盘),
+    整个解析过程占用的内存是有上限的
+    """
+    chunk_size = 64 * 1024
+    max_memory_size = 2621440  # 2.5M
+    max_field_size = 2621440
+    max_header_size = 8192
+
+    def __init__(self, stream, boundary, content_length, encoding='utf-8'):
+        if not boundary:
+            raise MultiPartParserError('Invalid boundary in multipart: %r' % boundary)
+        self.stream = stream
+        self.boundary = boundary.encode('latin-1')
+        self.content_length = content_length
+        self.encoding = encoding
+
+    def _read_chunks(self):
+        remaining = self.content_length
+        while remaining > 0:
+            chunk = self.stream.read(min(self.chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def _start_part(self, header_block):
+        headers = {}
+        for line in header_block.decode(self.encoding, 'replace').split('\r\n'):
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        disposition, params = parse_header(headers.get('content-disposition', ''))
+        if disposition != 'form-data' or 'name' not in params:
+            return None  # 不认识的 part, 内容直接丢弃
+        if 'filename' in params:
+            content_type, content_params = parse_header(headers.get('content-type', 'application/octet-stream'))
+            sink = tempfile.SpooledTemporaryFile(max_size=self.max_memory_size)
+            return [params['name'], sink, 0, params['filename'], content_type, content_params.get('charset')]
+        return [params['name'], bytearray(), 0, None, None, None]
+
+    def _write(self, part, data):
+        if part is None:
+            return
+        part[2] += len(data)
+        if part[3] is None and part[2] > self.max_field_size:
+            raise MultiPartParserError('Field %r exceeded max_field_size' % part[0])
+        if part[3] is None:
+            part[1] += data
+        else:
+            part[1].write(data)
+
+    def _finish_part(self, part, post, files):
+        if part is None:
+            return
+        name, sink, size, filename, content_type, charset = part
+        if filename is None:
+            post.appendlist(name, sink.decode(self.encoding, 'replace'))
+        else:
+            sink.seek(0)
+            files.appendlist(name, UploadedFile(sink, filename, content_type, size, charset))
+
+    def parse(self):
+        post, files = QueryDict(), QueryDict()
+        delimiter = b'--' + self.boundary
+        separator = b'\r\n' + delimiter
+        buffer = bytearray()
+        state, part = 'preamble', None
+        for chunk in self._read_chunks():
+            buffer += chunk
+            while True:
+                if state == 'preamble':
+                    index = buffer.find(delimiter)
+                    if index < 0:
+                        del buffer[:max(0, len(buffer) - len(delimiter))]
+                        break
+                    del buffer[:index + len(delimiter)]
+                    state = 'boundary'
+                if state == 'boundary':  # 分隔符后面跟 -- 表示结束, 否则是 \r\n 和下一个 part
+                    if len(buffer) < 2:
+                        break
+                    if buffer[:2] == b'--':
+                        return post, files
+                    index = buffer.find(b'\r\n')
+                    if index < 0:
+                        break
+                    del buffer[:index + 2]
+                    state = 'headers'
+                if state == 'headers':
+                    if buffer[:2] == b'\r\n':  # 没有任何头
+                        index, header_block = 0, b''
+                    else:
+                        index = buffer.find(b'\r\n\r\n')
+                        if index < 0:
+                            if len(buffer) > self.max_header_size:
+                                raise MultiPartParserError('Part headers exceeded max_header_size')
+                            break
+                        header_block = bytes(buffer[:index])
+                        index += 2
+                    del buffer[:index + 2]
+                    part = self._start_part(header_block)
+                    state = 'body'
+                if state == 'body':
+                    index = buffer.find(separator)
+                    if index < 0:  # 留下可能是分隔符前缀的尾巴, 其余写出去
+                        flush = len(buffer) - len(separator) + 1
+                        if flush > 0:
+                            self._write(part, buffer[:flush])
+                            del buffer[:flush]
+                        break
+                    self._write(part, buffer[:index])
+                    del buffer[:index + len(separator)]
+                    self._finish_part(part, post, files)
+                    part, state = None, 'boundary'
+        raise MultiPartParserError('Unexpected end of multipart body')
 
 
 class WSGIRequest:
-    """environ to request object"""
+    """
+    environ to request object
+    path/method 在创建时确定, 其余的 GET/POST/FILES/body/COOKIES/headers
+    都在第一次访问时才解析并缓存, 不访问就没有开销
+    """
     def __init__(self, environ):
         script_name = ''
         path_info = environ.get('PATH_INFO', '/')
@@ -113,16 +800,82 @@ class WSGIRequest:
         self.path = '%s/%s' % (script_name.rstrip('/'),
                                path_info.replace('/', '', 1))
         self.META = environ
-        self.META['PATH_INFO'] = path_info
-        self.META['SCRIPT_NAME'] = script_name
         self.method = environ['REQUEST_METHOD'].upper()
-        self.content_type, self.content_params = cgi.parse_header(environ.get('CONTENT_TYPE', ''))
+        self.route = None  # 路由解析后填入匹配到的路由正则
+        self._read_started = False
+
+    @cached_property
+    def _content_type_info(self):
+        return parse_header(self.META.get('CONTENT_TYPE', ''))
+
+    @property
+    def content_type(self):
+        return self._content_type_info[0]
+
+    @property
+    def content_params(self):
+        return self._content_type_info[1]
+
+    @property
+    def encoding(self):
+        return self.content_params.get('charset', 'utf-8')
 
+    @cached_property
+    def content_length(self):
         try:
-            content_length = int(environ.get('CONTENT_LENGTH'))
+            return int(self.META.get('CONTENT_LENGTH'))
         except (ValueError, TypeError):
-            content_length = 0
-        self.content_length = content_length
+            return 0
+
+    @cached_property
+    def GET(self):
+        # WSGI 中的 QUERY_STRING 是按 latin-1 解出来的 str
+        query_string = self.META.get('QUERY_STRING', '').encode('latin-1', 'replace')
+        return QueryDict(query_string)
+
+    @cached_property
+    def COOKIES(self):
+        cookie = SimpleCookie()
+        try:
+            cookie.load(self.META.get('HTTP_COOKIE', ''))
+        except CookieError:
+            return {}
+        return {key: morsel.value for key, morsel in cookie.items()}
+
+    @cached_property
+    def headers(self):
+        return HttpHeaders(self.META)
+
+    @cached_property
+    def body(self):
+        if self._read_started:
+            raise RawPostDataException("You cannot access body after reading from request's data stream")
+        self._read_started = True
+        if not self.content_length:
+            return b''
+        return self.META['wsgi.input'].read(self.content_length)
+
+    @cached_property
+    def _post_and_files(self):
+        if self.content_type == 'multipart/form-data':
+            if 'body' in self.__dict__:
+                stream = BytesIO(self.body)
+            else:
+                self._read_started = True
+                stream = self.META['wsgi.input']
+            boundary = self.content_params.get('boundary')
+            return MultiPartParser(stream, boundary, self.content_length, self.encoding).parse()
+        if self.content_type == 'application/x-www-form-urlencoded':
+            return QueryDict(self.body, self.encoding), QueryDict()
+        return QueryDict(), QueryDict()
+
+    @property
+    def POST(self):
+        return self._post_and_files[0]
+
+    @property
+    def FILES(self):
+        return self._post_and_files[1]
 
 
 class WSGIHandler(BaseHandler):
@@ -134,13 +887,22 @@ class WSGIHandler(BaseHandler):
         self.load_urls(kwargs["urlpatterns"])
 
     def __call__(self, environ, start_response):
+        start = time.perf_counter()
         request = self.request_class(environ)  # 将请求内容变成一个 request 对象
         response = self.get_response(request)
+        if metrics.ENABLED:  # 只统计到响应生成, 不包括服务器发送 body 的时间
+            metrics.REQUEST_DURATION.observe(time.perf_counter() - start, route=request.route or '',
+                                             method=request.method, status=response.status_code)
 
         status = '%d %s' % (response.status_code, response.reason_phrase)
-        response_headers = [('Content-type', 'text/plain; charset=utf-8')]
-        start_response(status, response_headers)
-
+        if not response.streaming and not response.has_header('Content-Length') \
+                and response.status_code not in (204, 304):
+            response['Content-Length'] = len(response.content)
+        start_response(status, list(response.items()))
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and getattr(response, 'file_to_stream', None) is not None:
+            return file_wrapper(response.file_to_stream, response.block_size)
         return response.render()
 
 
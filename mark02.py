@@ -1,72 +1,119 @@
 import socket
 import sys
-from io import StringIO
+import time
+import signal
+import selectors
+import threading
+import traceback
+from io import BytesIO
+from email.utils import formatdate
+from concurrent.futures import ThreadPoolExecutor
 
+import metrics
+from mark05 import Process
 
-class WSGIServer(object):
-    address_family = socket.AF_INET
-    socket_type = socket.SOCK_STREAM
-    request_queue_size = 1
 
-    def __init__(self, server_address):
-        self.listen_socket = listen_socket = socket.socket(
-            self.address_family,
-            self.socket_type
-        )
-        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listen_socket.bind(server_address)
-        listen_socket.listen(self.request_queue_size)
-        host, port = self.listen_socket.getsockname()[0:2]
-        self.server_name = socket.getfqdn(host)
-        self.server_port = port
-        self.headers_set = []
+class WSGIRequestHandler(object):
+    """一个连接对应一个 handler 实例, 连接相关的状态都保存在这里, 多个线程之间互不干扰"""
+    max_header_size = 65536
+    recv_size = 65536
 
-    def set_app(self, application):
-        self.application = application
+    def __init__(self, connection, client_address, server):
+        self.client_connection = connection
+        self.client_address = client_address
+        self.server = server
+        self.headers_set = []
+        self.debug = metrics.sample_debug()  # 按采样率决定是否打印这个请求的完整请求/响应头
+        self.request_data = b''
+        self.body = b''
+        self.headers = {}
 
-    def serve_forever(self):
-        listen_socket = self.listen_socket
-        while True:
-            self.client_connection, client_address = listen_socket.accept()
+    def handle(self):
+        try:
             self.handle_one_request()
+        finally:
+            self.client_connection.close()
 
     def handle_one_request(self):
-        self.request_data = request_data = self.client_connection.recv(1024)
-        print(''.join(
-            '< {line} \n'.format(line=line)
-            for line in request_data.splitlines()
-        ))
+        self.request_data = request_data = self.read_request()
+        if not request_data:
+            return
+        if self.debug:
+            print(''.join(
+                '< {line} \n'.format(line=line)
+                for line in request_data.decode('latin-1').splitlines()
+            ))
         self.parse_request(request_data)
         env = self.get_environ()
-        result = self.application(env, self.start_response)
+        result = self.server.application(env, self.start_response)
 
         # Construct a response and send it back to the client
         self.finish_response(result)
 
+    def read_request(self):
+        """读到请求头结束, 再按 Content-Length 读完 body"""
+        connection = self.client_connection
+        data = b''
+        while b'\r\n\r\n' not in data:
+            fragment = connection.recv(self.recv_size)
+            if not fragment:
+                return b''
+            data += fragment
+            if len(data) > self.max_header_size:
+                return b''
+        head, _, body = data.partition(b'\r\n\r\n')
+        content_length = 0
+        for line in head.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                content_length = int(value.strip() or 0)
+        while len(body) < content_length:
+            fragment = connection.recv(min(self.recv_size, content_length - len(body)))
+            if not fragment:
+                break
+            body += fragment
+        self.body = body[:content_length]
+        return head + b'\r\n\r\n'
+
     def parse_request(self, text):
-        request_line = text.splitlines()[0]
-        request_line = request_line.rstrip('\r\n')
-        self.request_method,  self.path, self.request_version = request_line.split()
+        lines = text.decode('latin-1').split('\r\n')
+        request_line = lines[0].rstrip('\r\n')
+        self.request_method, self.path, self.request_version = request_line.split()
+        self.headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                self.headers[name.strip().upper().replace('-', '_')] = value.strip()
 
     def get_environ(self):
+        path, _, query_string = self.path.partition('?')
         env = {}
         env['wsgi.version'] = (1, 0)
         env['wsgi.url_scheme'] = 'http'
-        env['wsgi.input'] = StringIO(self.request_data)
+        env['wsgi.input'] = BytesIO(self.body)
         env['wsgi.errors'] = sys.stderr
-        env['wsgi.multithread'] = False
-        env['wsgi.multiprocess'] = False
+        env['wsgi.multithread'] = self.server.multithread
+        env['wsgi.multiprocess'] = self.server.multiprocess
         env['wsgi.run_once'] = False
         env['REQUEST_METHOD'] = self.request_method  # GET
-        env['PATH_INFO'] = self.path  # /hello
-        env['SERVER_NAME'] = self.server_name  # localhost
-        env['SERVER_PORT'] = str(self.server_port)  # 8888
+        env['PATH_INFO'] = path  # /hello
+        env['QUERY_STRING'] = query_string
+        env['SERVER_PROTOCOL'] = self.request_version
+        env['SERVER_NAME'] = self.server.server_name  # localhost
+        env['SERVER_PORT'] = str(self.server.server_port)  # 8888
+        env['REMOTE_ADDR'] = self.client_address[0]
+        for name, value in self.headers.items():
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                env[name] = value
+            else:
+                env['HTTP_' + name] = value
         return env
 
-    def start_response(self, status, response_headers, exc_onfo=None):
+    def start_response(self, status, response_headers, exc_info=None):
         server_headers = [
-            ('Date', 'Tue, 31 Mar 2015 12:54:48 GMT'),
+            ('Date', formatdate(usegmt=True)),
             ('Server', 'WSGIServer 02'),
+            ('Connection', 'close'),
         ]
         self.headers_set = [status, response_headers + server_headers]
 
@@ -77,21 +124,219 @@ class WSGIServer(object):
             for header in response_headers:
                 response += '{0}: {1}\r\n'.format(*header)
             response += '\r\n'
+            if self.debug:
+                print(''.join(
+                    '> {line}\n'.format(line=line)
+                    for line in response.splitlines()
+                ))
+            self.client_connection.sendall(response.encode('latin-1'))
             for data in result:
-                response += data
-            print(''.join(
-                '> {line}\n'.format(line=line)
-                for line in response.splitlines()
-            ))
-            self.client_connection.sendall(response)
+                if data:
+                    self.client_connection.sendall(data)
+            if metrics.ENABLED:
+                metrics.REQUESTS_TOTAL.inc(server='mark02', status=status.split(' ', 1)[0])
         finally:
-            self.client_connection.close()
+            if hasattr(result, 'close'):
+                result.close()
+
+
+class WSGIServer(object):
+    """
+    threads 为 0 时在 serve_forever 所在线程里逐个处理连接,
+    大于 0 时交给 threads 个工作线程处理, 线程都忙时不再 accept, 新连接在内核的 backlog 中排队
+    """
+    address_family = socket.AF_INET
+    socket_type = socket.SOCK_STREAM
+    request_queue_size = 128  # listen backlog
+    handler_class = WSGIRequestHandler
+    timeout = 30  # 客户端连接的读写超时, 防止慢连接一直占着工作线程
+
+    def __init__(self, server_address, threads=0, request_queue_size=None, reuse_port=False):
+        if request_queue_size is not None:
+            self.request_queue_size = request_queue_size
+        self.listen_socket = listen_socket = socket.socket(
+            self.address_family,
+            self.socket_type
+        )
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:  # 多个进程各自绑定同一个端口, 由内核做负载均衡
+            listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listen_socket.bind(server_address)
+        listen_socket.listen(self.request_queue_size)
+        listen_socket.setblocking(False)
+        host, port = self.listen_socket.getsockname()[0:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+        self.threads = threads
+        self.multithread = bool(threads)
+        self.multiprocess = False
+        self._executor = None
+        self._slots = None
+        self._shutdown_request = False
+
+    def set_app(self, application):
+        self.application = application
+
+    def serve_forever(self, poll_interval=0.5):
+        self._shutdown_request = False
+        if self.threads:
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='wsgi-worker')
+            self._slots = threading.Semaphore(self.threads)
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(self.listen_socket, selectors.EVENT_READ)
+                while not self._shutdown_request:
+                    if self._slots is not None and not self._slots.acquire(timeout=poll_interval):
+                        continue
+                    if selector.select(poll_interval):
+                        self._handle_request_noblock()
+                    elif self._slots is not None:
+                        self._slots.release()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)  # 等正在处理的请求完成
+                self._executor = None
+
+    def shutdown(self):
+        """让 serve_forever 在下一次轮询时退出"""
+        self._shutdown_request = True
+
+    def _handle_request_noblock(self):
+        try:
+            connection, client_address = self.listen_socket.accept()
+        except (BlockingIOError, InterruptedError):  # 被其他进程/线程抢先 accept 了
+            if self._slots is not None:
+                self._slots.release()
+            return
+        connection.settimeout(self.timeout)
+        if self._executor is not None:
+            self._executor.submit(self.process_request, connection, client_address)
+        else:
+            self.process_request(connection, client_address)
+
+    def process_request(self, connection, client_address):
+        if metrics.ENABLED:
+            metrics.CONNECTIONS_TOTAL.inc(server='mark02')
+            metrics.CONNECTIONS_ACTIVE.inc(server='mark02')
+        try:
+            self.handler_class(connection, client_address, self).handle()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if metrics.ENABLED:
+                metrics.CONNECTIONS_ACTIVE.dec(server='mark02')
+            if self._slots is not None:
+                self._slots.release()
+
+    def server_close(self):
+        self.listen_socket.close()
+
+
+class PreforkMaster(object):
+    """
+    pre-fork 多进程模式, master 只负责 fork 和看护 worker, 每个 worker 各自运行 accept 循环
+    1.默认 master 绑定一次监听 socket, fork 出来的 worker 共享它
+    2.reuse_port=True 时每个 worker 自己用 SO_REUSEPORT 绑定端口, 由内核分配连接
+    3.worker 异常退出后 master 会重新 fork 一个
+    4.SIGHUP 平滑重启: 先启动新 worker, 再让旧 worker 处理完手上的请求后退出
+    5.SIGTERM/SIGINT 让所有 worker 处理完当前请求后退出, 然后 master 退出
+    """
+    check_interval = 0.5
+    graceful_timeout = 30
+
+    def __init__(self, server_address, application, workers=2, threads=0,
+                 request_queue_size=None, reuse_port=False):
+        self.server_address = server_address
+        self.application = application
+        self.worker_count = workers
+        self.threads = threads
+        self.request_queue_size = request_queue_size
+        self.reuse_port = reuse_port
+        self.server = None
+        if not reuse_port:
+            self.server = self.create_server()
+            self.server_address = self.server.listen_socket.getsockname()[:2]
+        self.workers = []
+        self._running = False
+        self._reload_requested = False
+
+    def create_server(self):
+        server = WSGIServer(self.server_address, self.threads, self.request_queue_size, self.reuse_port)
+        server.multiprocess = True
+        server.set_app(self.application)
+        return server
+
+    def spawn_worker(self):
+        worker = Process(target=self.worker_main)
+        worker.start()
+        return worker
+
+    def worker_main(self):
+        server = self.server if self.server is not None else self.create_server()
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C 由 master 统一处理
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        server.serve_forever()
+
+    def serve_forever(self):
+        self._running = True
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        self.workers = [self.spawn_worker() for _ in range(self.worker_count)]
+        try:
+            while self._running:
+                if self._reload_requested:
+                    self._reload_requested = False
+                    self.reload()
+                for index, worker in enumerate(self.workers):
+                    if not worker.is_alive():
+                        print('worker %s exited with code %s, restarting' % (worker.pid, worker.exitcode))
+                        self.workers[index] = self.spawn_worker()
+                time.sleep(self.check_interval)
+        finally:
+            self.stop_workers(self.workers)
+            self.workers = []
+
+    def reload(self):
+        old_workers = self.workers
+        self.workers = [self.spawn_worker() for _ in range(self.worker_count)]
+        self.stop_workers(old_workers)
+
+    def stop_workers(self, workers):
+        for worker in workers:
+            worker.terminate()
+        deadline = time.monotonic() + self.graceful_timeout
+        for worker in workers:
+            worker.join(max(0, deadline - time.monotonic()))
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
+
+    def shutdown(self):
+        self._running = False
+
+    def _handle_reload(self, signum, frame):
+        self._reload_requested = True
+
+    def _handle_stop(self, signum, frame):
+        self._running = False
+
+    def server_close(self):
+        if self.server is not None:
+            self.server.server_close()
 
 
 SERVER_ADDRESS = (HOST, PORT) = '', 8888
 
 
-def make_server(server_address, application):
-    server = WSGIServer(server_address)
+def make_server(server_address, application, threads=0, request_queue_size=None,
+                workers=0, reuse_port=False):
+    """workers 大于 0 时返回 pre-fork 的 PreforkMaster, 接口同样是 serve_forever"""
+    if workers:
+        return PreforkMaster(server_address, application, workers, threads,
+                             request_queue_size, reuse_port)
+    server = WSGIServer(server_address, threads, request_queue_size, reuse_port)
     server.set_app(application)
     return server
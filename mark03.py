@@ -5,14 +5,193 @@ WSGI Server 和 Web Framework
 非阻塞就不会挂起，因为Tornado会想办法让自己避免被挂起
 """
 
+import os
 import sys
+import errno
+import stat
 import time
+import heapq
+import inspect
+import signal
 import socket
+import itertools
+import functools
+import threading
 import collections
 import selectors
 import logging
 from datetime import datetime
-from io import StringIO
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+import metrics
+from mark02 import PreforkMaster
+
+
+class Waker:
+    """
+    self-pipe: 其他线程调用 add_callback 时往 writer 写一个字节,
+    把阻塞在 select 上的 IOLoop 立即唤醒
+    """
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(0)
+        self.writer.setblocking(0)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def wake(self):
+        try:
+            self.writer.send(b'x')
+        except OSError:  # 缓冲区满说明已经有未处理的唤醒
+            pass
+
+    def consume(self, fd_obj, event):
+        try:
+            while self.reader.recv(1024):
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+class Timeout:
+    """call_at/call_later 返回的定时器句柄, 传给 remove_timeout 取消"""
+    __slots__ = ('deadline', 'callback', 'cancelled')
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+
+class Future:
+    """
+    IOLoop 上的 Future, 只能在 IOLoop 线程中使用, 可以 await;
+    完成后回调通过 add_callback 在下一轮循环执行, 不会在 set_result 中嵌套调用
+    """
+    _PENDING, _FINISHED, _CANCELLED = 'pending', 'finished', 'cancelled'
+
+    def __init__(self, ioloop=None):
+        self.ioloop = ioloop if ioloop is not None else IOLoop.current()
+        self._state = self._PENDING
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._state != self._PENDING
+
+    def cancelled(self):
+        return self._state == self._CANCELLED
+
+    def result(self):
+        if self._state == self._CANCELLED:
+            raise CancelledError()
+        if self._state == self._PENDING:
+            raise RuntimeError('future is not done')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        if self._state == self._CANCELLED:
+            raise CancelledError()
+        return self._exception
+
+    def set_result(self, result):
+        if self.done():
+            raise RuntimeError('future already done')
+        self._result = result
+        self._state = self._FINISHED
+        self._schedule_callbacks()
+
+    def set_exception(self, exception):
+        if self.done():
+            raise RuntimeError('future already done')
+        self._exception = exception
+        self._state = self._FINISHED
+        self._schedule_callbacks()
+
+    def cancel(self):
+        if self.done():
+            return False
+        self._state = self._CANCELLED
+        self._schedule_callbacks()
+        return True
+
+    def add_done_callback(self, callback):
+        if self.done():
+            self.ioloop.add_callback(callback, self)
+        else:
+            self._callbacks.append(callback)
+
+    def _schedule_callbacks(self):
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self.ioloop.add_callback(callback, self)
+
+    def __await__(self):
+        if not self.done():
+            yield self  # 交给 Task, 完成后再 send 回来
+        return self.result()
+
+
+class Task(Future):
+    """
+    协程运行器: 每次协程 await 一个 Future 时挂起, Future 完成后在 IOLoop 中继续执行;
+    cancel() 在协程下一次恢复时抛出 CancelledError, 协程没有捕获时 Task 变成 cancelled
+    """
+
+    def __init__(self, coro, ioloop=None):
+        super(Task, self).__init__(ioloop)
+        self._coro = coro
+        self._waiting = None  # 协程正在 await 的 Future
+        self._must_cancel = False
+        self.ioloop.add_callback(self._step)
+
+    def cancel(self):
+        if self.done():
+            return False
+        self._must_cancel = True
+        if self._waiting is not None:  # 取消正在等的 Future, 完成回调会让协程恢复
+            self._waiting.cancel()
+        return True
+
+    def _step(self, future=None, error=None):
+        if self.done():  # 已经结束, 比如过期的回调
+            return
+        self._waiting = None
+        if self._must_cancel:
+            self._must_cancel = False
+            error = CancelledError()
+        elif future is not None and future.cancelled():
+            error = CancelledError()
+        elif future is not None:
+            error = future.exception()
+        try:
+            if error is not None:
+                yielded = self._coro.throw(error)
+            else:
+                yielded = self._coro.send(None)
+        except StopIteration as stop:
+            self.set_result(stop.value)
+            return
+        except CancelledError:
+            super(Task, self).cancel()
+            return
+        except Exception as exception:
+            self.set_exception(exception)
+            return
+        if isinstance(yielded, Future):
+            self._waiting = yielded
+            yielded.add_done_callback(self._step)
+        else:
+            self._step(error=TypeError('Task can only await mark03 Future, got %r' % (yielded,)))
 
 
 class IOLoop:
@@ -25,29 +204,59 @@ class IOLoop:
     WRITE = _EPOLLOUT
     ERROR = _EPOLLERR | _EPOLLHUP
 
-    PULL_TIMEOUT = 1
+    PULL_TIMEOUT = 1  # 没有定时器时 select 最长等待时间
+
+    _current = threading.local()
 
     def __init__(self):
         self.handlers = {}
-        self.events = {}
         # self.epoll = select.epoll()
         self._selector = selectors.DefaultSelector()
 
         self._future_callbacks = collections.deque()
+        self._timeouts = []  # 最小堆 [(deadline, 序号, Timeout)]
+        self._timeout_counter = itertools.count()
+        self._cancellations = 0
+        self._running = False
+        self._thread_ident = None
+        self._pid = os.getpid()
+        self._executor = None  # run_in_executor 默认使用的线程池, 用到时才创建
+        self._instrumented = False  # start 时根据 metrics.ENABLED 决定是否记录耗时
+
+        self._waker = Waker()
+        self.add_handler(self._waker, self._waker.consume, self.READ)
+
+    @classmethod
+    def current(cls):
+        """每个线程(以及 fork 出来的每个进程)各自有一个 IOLoop, 不再是全局单例"""
+        loop = getattr(cls._current, 'instance', None)
+        if loop is None or loop._pid != os.getpid():
+            loop = cls._current.instance = cls()
+        return loop
+
+    def make_current(self):
+        IOLoop._current.instance = self
 
     @staticmethod
-    def instance():  # 只允许创建一个实例
-        if not hasattr(IOLoop, '_instance'):
-            IOLoop._instance = IOLoop()
-        return IOLoop._instance
+    def instance():  # 兼容旧接口, 等同于 current()
+        return IOLoop.current()
+
+    @classmethod
+    def _to_selector_events(cls, event):
+        events = 0
+        if event & cls.READ:
+            events |= selectors.EVENT_READ
+        if event & cls.WRITE:
+            events |= selectors.EVENT_WRITE
+        return events
 
     def add_handler(self, fd_obj, handler, event):
         fd = fd_obj.fileno()
         self.handlers[fd] = (fd_obj, handler)
-        self._selector.register(fd, event)
+        self._selector.register(fd, self._to_selector_events(event))
 
     def update_handler(self, fd, event):
-        self._selector.modify(fd, event)
+        self._selector.modify(fd, self._to_selector_events(event))
 
     def remove_handler(self, fd):
         self.handlers.pop(fd, None)
@@ -59,137 +268,872 @@ class IOLoop:
     def replace_handler(self, fd, handler):
         self.handlers[fd] = (self.handlers[fd][0], handler)
 
+    def time(self):
+        return time.monotonic()
+
+    def call_at(self, deadline, callback, *args):
+        """在 deadline(IOLoop.time() 的时间)执行 callback, 只能在 IOLoop 线程中调用"""
+        timeout = Timeout(deadline, functools.partial(callback, *args))
+        heapq.heappush(self._timeouts, (deadline, next(self._timeout_counter), timeout))
+        return timeout
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def remove_timeout(self, timeout):
+        """取消定时器, 只打标记, 取消的多了再整体清理堆"""
+        if timeout is None or timeout.cancelled:
+            return
+        timeout.cancelled = True
+        self._cancellations += 1
+        if self._cancellations > 512 and self._cancellations > len(self._timeouts) // 2:
+            self._timeouts = [item for item in self._timeouts if not item[2].cancelled]
+            heapq.heapify(self._timeouts)
+            self._cancellations = 0
+
+    def add_callback(self, callback, *args):
+        """在下一轮循环执行 callback, 可以在任意线程中调用"""
+        self._future_callbacks.append(functools.partial(callback, *args))
+        if self._thread_ident != threading.get_ident():
+            self._waker.wake()
+
+    def add_callback_from_signal(self, callback, *args):
+        """信号处理函数中使用: 信号打断的 select 会被自动重试, 必须主动唤醒"""
+        self._future_callbacks.append(functools.partial(callback, *args))
+        self._waker.wake()
+
+    def stop(self):
+        self._running = False
+        self._waker.wake()
+
+    def create_task(self, coro):
+        """在这个 IOLoop 上运行协程, 返回 Task"""
+        return Task(coro, self)
+
+    def run_sync(self, func, *args):
+        """启动 IOLoop 运行协程函数 func, 运行结束后停止并返回结果"""
+        task = self.create_task(func(*args))
+        task.add_done_callback(lambda future: self.stop())
+        self.start()
+        return task.result()
+
+    def sleep(self, seconds, result=None):
+        future = Future(self)
+
+        def wake():
+            if not future.done():
+                future.set_result(result)
+
+        timeout = self.call_later(seconds, wake)
+        # 被取消(比如 Task.cancel)时删掉定时器
+        future.add_done_callback(lambda future: future.cancelled() and self.remove_timeout(timeout))
+        return future
+
+    def _wait_fd(self, fd_obj, event):
+        future = Future(self)
+        fd = fd_obj.fileno()
+
+        def ready(fd_obj, events):
+            self.remove_handler(fd)
+            if not future.done():
+                future.set_result(events)
+
+        def cancelled(future):
+            # 被取消时注销 fd, 之后可以再次等待同一个 fd; 这个回调先于 Task 的回调执行
+            if future.cancelled() and self.handlers.get(fd, (None, None))[1] is ready:
+                self.remove_handler(fd)
+
+        self.add_handler(fd_obj, ready, event | self.ERROR)
+        future.add_done_callback(cancelled)
+        return future
+
+    def wait_readable(self, fd_obj):
+        """await 到 fd_obj 可读, fd_obj 不能已经注册在 IOLoop 上"""
+        return self._wait_fd(fd_obj, self.READ)
+
+    def wait_writable(self, fd_obj):
+        return self._wait_fd(fd_obj, self.WRITE)
+
+    def wrap_future(self, concurrent_future):
+        """把线程池返回的 concurrent.futures.Future 转成可以 await 的 Future"""
+        future = Future(self)
+
+        def copy(done):
+            if future.done():
+                return
+            if done.cancelled():
+                future.cancel()
+            elif done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(done.result())
+
+        concurrent_future.add_done_callback(lambda done: self.add_callback(copy, done))
+        return future
+
+    def run_in_executor(self, executor, func, *args):
+        """executor 为 None 时使用 IOLoop 自己的线程池"""
+        if executor is None:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(thread_name_prefix='ioloop-executor')
+            executor = self._executor
+        return self.wrap_future(executor.submit(func, *args))
+
+    async def sock_recv(self, sock, size):
+        while True:
+            try:
+                return sock.recv(size)
+            except (BlockingIOError, InterruptedError):
+                await self.wait_readable(sock)
+
+    async def sock_sendall(self, sock, data):
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[sock.send(view):]
+            except (BlockingIOError, InterruptedError):
+                await self.wait_writable(sock)
+
+    async def sock_connect(self, sock, address):
+        """sock 需要是非阻塞的"""
+        error = sock.connect_ex(address)
+        if error in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            await self.wait_writable(sock)
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise OSError(error, os.strerror(error))
+
+    def _run_callback(self, callback, *args):
+        if self._instrumented:
+            start = time.perf_counter()
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception('ioloop callback error')
+        if self._instrumented:
+            metrics.IOLOOP_CALLBACK.observe(time.perf_counter() - start)
+
+    def _poll_timeout(self):
+        if self._future_callbacks:
+            return 0
+        while self._timeouts and self._timeouts[0][2].cancelled:
+            heapq.heappop(self._timeouts)
+            self._cancellations -= 1
+        if self._timeouts:
+            return min(max(0, self._timeouts[0][0] - self.time()), self.PULL_TIMEOUT)
+        return self.PULL_TIMEOUT
+
     def start(self):
+        self._running = True
+        self._thread_ident = threading.get_ident()
+        self.make_current()  # 运行中的协程通过 IOLoop.current() 拿到的必须是这个 loop
+        instrumented = self._instrumented = metrics.ENABLED
+        busy_start = time.perf_counter()
         try:
-            while True:
+            while self._running:
                 for i in range(len(self._future_callbacks)):
                     callback = self._future_callbacks.popleft()
-                    callback()
-
-                events = self._selector.select(self.PULL_TIMEOUT)
-                self.events.update(events)
-                while self.events:
-                    fd, event = self.events.popitem()
-                    try:
-                        fd_obj, handler = self.handlers[fd]
-                        handler(fd_obj, event)
-                    except Exception as error:
-                        print('ioloop callback error: %r' % error)
-                        time.sleep(0.5)
+                    self._run_callback(callback)
+
+                now = self.time()
+                while self._timeouts and self._timeouts[0][0] <= now:
+                    _, _, timeout = heapq.heappop(self._timeouts)
+                    if timeout.cancelled:
+                        self._cancellations -= 1
+                    else:
+                        timeout.cancelled = True
+                        if instrumented:  # 定时器比预定时间晚了多久执行, 反映 IOLoop 的繁忙程度
+                            metrics.IOLOOP_LAG.observe(now - timeout.deadline)
+                        self._run_callback(timeout.callback)
+
+                if instrumented:
+                    select_start = time.perf_counter()
+                    metrics.IOLOOP_ITERATION.observe(select_start - busy_start)
+                events = self._selector.select(self._poll_timeout())
+                if instrumented:
+                    busy_start = time.perf_counter()
+                    metrics.IOLOOP_SELECT.observe(busy_start - select_start)
+                for key, mask in events:
+                    handler = self.handlers.get(key.fd)
+                    if handler is None:  # 同一轮中前面的回调已经移除了它
+                        continue
+                    event = 0
+                    if mask & selectors.EVENT_READ:
+                        event |= self.READ
+                    if mask & selectors.EVENT_WRITE:
+                        event |= self.WRITE
+                    fd_obj, callback = handler
+                    self._run_callback(callback, fd_obj, event)
         finally:
-            for fd, _ in self.handlers.items():
-                self.remove_handler(fd)
-            self._selector.close()
+            self._thread_ident = None
+
+    def close(self):
+        for fd in list(self.handlers):
+            self.remove_handler(fd)
+        self._waker.close()
+        self._selector.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
 
 
 EOL1 = b'\n\n'
 EOL2 = b'\n\r\n'
+CRLF = b'\r\n'
+HEADER_END = b'\r\n\r\n'
+
+
+@functools.lru_cache(maxsize=None)
+def static_response(status, retry_after=None):
+    """没有 body 并且关闭连接的错误响应, 按状态缓存编码好的 bytes"""
+    response = 'HTTP/1.1 {0}\r\nContent-Length: 0\r\nConnection: close\r\n'.format(status)
+    if retry_after is not None:
+        response += 'Retry-After: {0}\r\n'.format(retry_after)
+    return (response + '\r\n').encode('latin-1')
+
+
+class FileWrapper:
+    """
+    wsgi.file_wrapper: 应用返回它时, 服务器直接用 os.sendfile 从文件发送到 socket, 数据不经过 Python;
+    文件没有 fileno (比如 BytesIO) 时退化为按 blksize 分块迭代
+    """
+    def __init__(self, filelike, blksize=65536):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.blksize), b'')
+
+    def fileno(self):
+        return self.filelike.fileno()
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+
+def parse_range(header, size):
+    """
+    只支持单个区间 bytes=start-end / start- / -suffix, 返回 [start, stop),
+    格式不对或者多个区间时返回 None(忽略 Range, 发送完整内容), 区间不可满足时抛 416
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    start, sep, end = spec.strip().partition('-')
+    try:
+        if not sep:
+            return None
+        if not start:  # 最后 N 个字节
+            length = int(end)
+            if length <= 0:
+                raise HTTPParseError('416 Range Not Satisfiable')
+            return max(0, size - length), size
+        start = int(start)
+        stop = int(end) + 1 if end else size
+    except ValueError:
+        return None
+    if start >= size:
+        raise HTTPParseError('416 Range Not Satisfiable')
+    if start < 0 or stop <= start:
+        return None
+    return start, min(stop, size)
+
+
+class HTTPParseError(Exception):
+    """请求格式错误或超出限制, status 是要回复给客户端的状态"""
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class RequestParser:
+    """
+    可以断点续传的增量请求解析器, 每次 feed 只处理新收到的数据:
+    查找请求头结尾时记住已经查过的位置, body 支持 Content-Length 和 chunked 两种方式
+    """
+    MAX_HEADER_SIZE = 65536
+    MAX_BODY_SIZE = 16 * 1024 * 1024
+    MAX_LINE_SIZE = 4096  # chunk size 行和 trailer 行
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.state = 'headers'
+        self.head = None
+        self.body = bytearray()
+        self._scan_pos = 0
+        self._remaining = 0
+
+    def feed(self, buffer):
+        """从 buffer(bytearray) 头部消费数据, 收齐一个请求时返回 True, 多出来的数据留在 buffer 中"""
+        while True:
+            if self.state == 'headers':
+                index = buffer.find(HEADER_END, max(0, self._scan_pos - len(HEADER_END) + 1))
+                if index < 0:
+                    self._scan_pos = len(buffer)
+                    if len(buffer) > self.MAX_HEADER_SIZE:
+                        raise HTTPParseError('431 Request Header Fields Too Large')
+                    return False
+                self.head = buffer[:index].decode('latin-1')
+                del buffer[:index + len(HEADER_END)]
+                self._scan_pos = 0
+                self._check_head()
+                self._start_body()
+            elif self.state == 'body':
+                if not self._take(buffer):
+                    return False
+                self.state = 'done'
+            elif self.state == 'chunk_size':
+                line = self._read_line(buffer)
+                if line is None:
+                    return False
+                try:
+                    size = int(line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise HTTPParseError('400 Bad Request')
+                if size < 0 or len(self.body) + size > self.MAX_BODY_SIZE:
+                    raise HTTPParseError('413 Payload Too Large')
+                self._remaining = size
+                self.state = 'chunk_data' if size else 'trailers'
+            elif self.state == 'chunk_data':
+                if not self._take(buffer):
+                    return False
+                self.state = 'chunk_end'
+            elif self.state == 'chunk_end':
+                if len(buffer) < len(CRLF):
+                    return False
+                if buffer[:len(CRLF)] != CRLF:
+                    raise HTTPParseError('400 Bad Request')
+                del buffer[:len(CRLF)]
+                self.state = 'chunk_size'
+            elif self.state == 'trailers':
+                line = self._read_line(buffer)
+                if line is None:
+                    return False
+                if not line:  # 空行表示 trailer 结束
+                    self.state = 'done'
+            else:
+                return True
+
+    def _check_head(self):
+        """请求行必须是 "方法 路径 HTTP/x.y", 整个请求头里不能有单独的 LF"""
+        if '\n' in self.head.replace('\r\n', ''):
+            raise HTTPParseError('400 Bad Request')
+        parts = self.head.split('\r\n', 1)[0].split(' ')
+        if len(parts) != 3 or not all(parts) or not parts[2].startswith('HTTP/'):
+            raise HTTPParseError('400 Bad Request')
+
+    def _start_body(self):
+        chunked, content_length = False, 0
+        for line in self.head.split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            if name == 'transfer-encoding':
+                chunked = 'chunked' in value.lower()
+            elif name == 'content-length':
+                try:
+                    content_length = int(value.strip())
+                except ValueError:
+                    raise HTTPParseError('400 Bad Request')
+        if chunked:
+            self.state = 'chunk_size'
+        elif content_length > self.MAX_BODY_SIZE:
+            raise HTTPParseError('413 Payload Too Large')
+        elif content_length > 0:
+            self._remaining = content_length
+            self.state = 'body'
+        else:
+            self.state = 'done'
+
+    def _read_line(self, buffer):
+        index = buffer.find(CRLF, max(0, self._scan_pos - len(CRLF) + 1))
+        if index < 0:
+            self._scan_pos = len(buffer)
+            if len(buffer) > self.MAX_LINE_SIZE:
+                raise HTTPParseError('400 Bad Request')
+            return None
+        line = bytes(buffer[:index])
+        del buffer[:index + len(CRLF)]
+        self._scan_pos = 0
+        return line
+
+    def _take(self, buffer):
+        """把 buffer 中属于 body 的数据搬到 self.body, 收齐 _remaining 字节时返回 True"""
+        size = min(self._remaining, len(buffer))
+        if size:
+            with memoryview(buffer) as view, view[:size] as part:
+                self.body += part
+            del buffer[:size]
+            self._remaining -= size
+        return self._remaining == 0
 
 
 class Connection:
     def __init__(self, fd):
         self.fd = fd
-        self.request_buffer = []
+        self.request_buffer = bytearray()
+        self.parser = RequestParser()
         self.handled = False
-        self.response = b''
+        self.write_queue = collections.deque()  # 待发送的 memoryview, sendmsg 一次发出多块
+        self.body = None  # 应用返回的可迭代对象, 边发送边取
+        self.body_iter = None
+        self.chunked = False
+        self.bytes_sent = 0
+        self.file = None  # sendfile 发送的 (文件描述符, 下一个偏移, 剩余字节数)
 
         self.headers = None
         self.status = None
         self.address = None
+        self.timeout = None  # 当前生效的超时定时器
+
+        self.request = None  # 当前正在处理的请求 (请求头文本, body)
+        self.keep_alive = False
+        self.receiving = False  # keep-alive 连接上是否已经开始接收下一个请求
+        self.requests_handled = 0
+
+    def reset(self):
+        """一个请求处理完后, 为同一连接上的下一个请求重置状态"""
+        self.parser.reset()
+        self.handled = False
+        self.write_queue.clear()
+        self.body = None
+        self.body_iter = None
+        self.chunked = False
+        self.bytes_sent = 0
+        self.file = None
+        self.headers = None
+        self.status = None
+        self.request = None
+        self.receiving = False
+        self.requests_handled += 1
 
 
 class WSGIServer:
     ADDRESS_FAMILY = socket.AF_INET
     SOCKET_TYPE = socket.SOCK_STREAM
-    BACKLOG = 5
+    BACKLOG = 128  # listen backlog, 突发连接在内核中排队
+    ACCEPT_BATCH = 64  # 一次可读事件最多 accept 多少个连接, 避免 accept 饿死其他连接
+    MAX_CONNECTIONS = 1024  # 同时保持的连接数上限
+
+    HEADER_TIMEOUT = 10  # 连接建立后多久内必须收完请求头
+    READ_TIMEOUT = 30  # 接收请求 body 时多久没有任何进展就断开
+    WRITE_TIMEOUT = 30  # 发送响应时多久没有任何进展就断开
+    KEEPALIVE_TIMEOUT = 15  # keep-alive 连接两个请求之间最长空闲时间
+    MAX_KEEPALIVE_REQUESTS = 100  # 一个连接最多处理多少个请求
+
+    RECV_SIZE = 65536
+    IOV_MAX = 64  # 一次 sendmsg 最多发送的块数
+    WRITE_BUFFER_CHUNKS = 16  # 写队列中最多预取多少块应用返回的 body
+
+    SENDFILE_CHUNK = 1 << 20  # 一次 sendfile 最多发送的字节数, 避免一个大文件占住 IOLoop
+    SUPPORT_RANGE = True  # 文件响应是否支持 Range 请求
+
+    EXECUTOR_QUEUE_SIZE = 64  # 线程池模式下最多排队的请求数, 超过直接回复 503
+    LINGER_TIMEOUT = 2  # 过载回复 503 后最多等多久让客户端读完再关闭
 
     HEADER_DATE_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
     SERVER_NAME = 'test/WSGIServer 0.3'
 
-    def __init__(self, server_address):
-        self.ssocket = self.setup_server_socket(server_address)
+    DRAIN_TIMEOUT = 10  # 平滑退出时最多等待多久让现有连接处理完
+
+    def __init__(self, server_address, executor_workers=0, executor_queue_size=None,
+                 ioloop=None, reuse_port=False, backlog=None, max_connections=None,
+                 accept_batch=None, reject_overload=False):
+        """
+        executor_workers 大于 0 时, 应用调用放到线程池中执行, 慢的 view 不会阻塞 IOLoop;
+        正在执行和排队的请求数超过 executor_workers + executor_queue_size 时直接回复 503
+        ioloop 默认使用当前线程的 IOLoop, reuse_port=True 时监听 socket 开启 SO_REUSEPORT
+        连接数达到 max_connections 时暂停 accept, 新连接留在内核 backlog 中;
+        reject_overload=True 时改为继续 accept, 超出的连接直接回复 503 后关闭
+        """
+        if backlog is not None:
+            self.BACKLOG = backlog
+        if max_connections is not None:
+            self.MAX_CONNECTIONS = max_connections
+        if accept_batch is not None:
+            self.ACCEPT_BATCH = accept_batch
+        self.reject_overload = reject_overload
+        self._accepting = False
+
+        self.ssocket = self.setup_server_socket(server_address, reuse_port, self.BACKLOG)
         host, self.server_port = self.ssocket.getsockname()[:2]
         self.server_name = socket.getfqdn(host)
 
-        self.ioloop = IOLoop.instance()
+        self.ioloop = ioloop if ioloop is not None else IOLoop.current()
         self.conn_pool = {}
+        self.multithread = False
+        self.multiprocess = False
+        self._draining = False
+
+        self.executor = None
+        self.executor_limit = 0
+        self._pending = 0  # 已提交到线程池还没有返回的请求数, 只在 IOLoop 线程中修改
+        if executor_workers:
+            if executor_queue_size is None:
+                executor_queue_size = self.EXECUTOR_QUEUE_SIZE
+            self.executor = ThreadPoolExecutor(executor_workers, thread_name_prefix='wsgi-app')
+            self.executor_limit = executor_workers + executor_queue_size
 
     @classmethod
-    def setup_server_socket(cls, server_address):
+    def setup_server_socket(cls, server_address, reuse_port=False, backlog=None):
         ssocket = socket.socket(cls.ADDRESS_FAMILY, cls.SOCKET_TYPE)
-        ssocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # SO_REUSEPORT
+        ssocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:  # 每个 IOLoop 各自监听同一个端口, 由内核分配连接
+            ssocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         ssocket.bind(server_address)
-        ssocket.listen(cls.BACKLOG)
+        ssocket.listen(cls.BACKLOG if backlog is None else backlog)
         ssocket.setblocking(0)
         return ssocket
 
     def set_app(self, application):
+        """application 可以是普通 WSGI 应用, 也可以是 async def app(environ, start_response)"""
         self.application = application
+        self.async_application = inspect.iscoroutinefunction(application) or \
+            inspect.iscoroutinefunction(getattr(application, '__call__', None))
 
     def _accept(self, ssocket, event):
         if event & IOLoop.ERROR:
             self._close(ssocket)
+            return
+        self._accept_batch(ssocket, self.ACCEPT_BATCH)
+
+    def _accept_batch(self, ssocket, limit):
+        """一直 accept 到 EAGAIN 或者 limit 个, 返回 accept 的连接数"""
+        for accepted in range(limit):
+            if len(self.conn_pool) >= self.MAX_CONNECTIONS and not self.reject_overload:
+                self._pause_accepting()
+                return accepted
+            try:
+                connect, addr = ssocket.accept()
+            except (BlockingIOError, InterruptedError):  # backlog 已经取空, 或者被其他 worker 抢先了
+                return accepted
+            except OSError as error:  # EMFILE 等, 等下一次可读事件再试
+                logging.warning('accept failed: %r', error)
+                return accepted
+            if len(self.conn_pool) >= self.MAX_CONNECTIONS:
+                self._reject_overload(connect)
+                continue
+            self._add_connection(connect, addr)
+        return limit
+
+    def _pause_accepting(self):
+        if self._accepting:
+            self._accepting = False
+            self.ioloop.remove_handler(self.ssocket.fileno())
 
-        connect, addr = ssocket.accept()
+    def _resume_accepting(self):
+        if not self._accepting and not self._draining:
+            self._accepting = True
+            self.ioloop.add_handler(self.ssocket, self._accept, IOLoop.READ | IOLoop.ERROR)
+
+    def _reject_overload(self, connect):
+        """
+        过载时不解析请求, 直接回复一个固定的 503;
+        接收缓冲区里还有没读的请求时直接 close 内核会发 RST, 客户端可能收不到 503,
+        所以只关闭写端, 丢弃客户端发来的数据, 等客户端关闭或者 LINGER_TIMEOUT 后再关闭
+        """
+        try:
+            connect.setblocking(0)
+            connect.send(static_response('503 Service Unavailable', retry_after=1))
+            connect.shutdown(socket.SHUT_WR)
+        except OSError:
+            connect.close()
+            return
+        ioloop = self.ioloop
+        fd = connect.fileno()
+
+        def close():
+            ioloop.remove_handler(fd)
+            ioloop.remove_timeout(timeout)
+            connect.close()
+
+        def discard(connect, event):
+            try:
+                data = connect.recv(self.RECV_SIZE)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b''
+            if not data:
+                close()
+
+        ioloop.add_handler(connect, discard, IOLoop.READ | IOLoop.ERROR)
+        timeout = ioloop.call_later(self.LINGER_TIMEOUT, close)
+
+    def _add_connection(self, connect, addr):
         connect.setblocking(0)
-        ioloop = IOLoop.instance()
+        ioloop = self.ioloop
         ioloop.add_handler(connect, self._receive, IOLoop.READ)
 
         fd = connect.fileno()
         connection = Connection(fd)
         connection.address = addr
         self.conn_pool[fd] = connection
+        self._set_timeout(connect, connection, self.HEADER_TIMEOUT)
+        if metrics.ENABLED:
+            metrics.CONNECTIONS_TOTAL.inc(server='mark03')
+            metrics.CONNECTIONS_ACTIVE.inc(server='mark03')
 
-    def _receive(self, connect, event):
-        if event & IOLoop.ERROR:
+    def _set_timeout(self, connect, connection, seconds):
+        """替换连接当前的超时定时器, 超时后直接关闭连接, 释放 conn_pool"""
+        ioloop = self.ioloop
+        ioloop.remove_timeout(connection.timeout)
+        connection.timeout = ioloop.call_later(seconds, self._on_timeout, connect, connection)
+
+    def _on_timeout(self, connect, connection):
+        if self.conn_pool.get(connection.fd) is connection:
+            logging.info('%s connection timed out', connection.address[0])
             self._close(connect)
 
+    def _receive(self, connect, event):
         fd = connect.fileno()
         connection = self.conn_pool[fd]
-        fragment = connect.recv(1024)
-        connection.request_buffer.append(fragment)
+        try:
+            fragment = connect.recv(self.RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            fragment = b''
+        if not fragment:  # 对端关闭或出错
+            self._close(connect)
+            return
+        connection.request_buffer += fragment
 
-        last_fragment = ''.join(connection.request_buffer[:2])
-        if EOL2 in last_fragment:
-            ioloop = IOLoop.instance()
+        ready = self._parse_request(connect, connection)
+        if ready:
+            if self.executor is not None or self.async_application:
+                self._submit(connect, connection)
+                return
+            ioloop = self.ioloop
             ioloop.update_handler(fd, IOLoop.WRITE)
             ioloop.replace_handler(fd, self._send)
+            self._set_timeout(connect, connection, self.WRITE_TIMEOUT)
+        elif ready is None:
+            return
+        elif connection.parser.state != 'headers':  # 正在接收 body
+            self._set_timeout(connect, connection, self.READ_TIMEOUT)
+        elif connection.requests_handled and not connection.receiving:  # keep-alive 连接开始收下一个请求
+            connection.receiving = True
+            self._set_timeout(connect, connection, self.HEADER_TIMEOUT)
 
-    def _send(self, connect, event):
-        if event & IOLoop.ERROR:
-            self._close(connect)
+    def _parse_request(self, connect, connection):
+        """
+        把缓冲区交给解析器, 收齐一个请求时放到 connection.request 并返回 True,
+        剩下的数据(pipelining 的后续请求)留在缓冲区里; 请求有误时回复错误, 关闭连接并返回 None
+        """
+        try:
+            ready = connection.parser.feed(connection.request_buffer)
+        except HTTPParseError as error:
+            self._reject(connect, error.status)
+            return None
+        if ready:
+            connection.request = (connection.parser.head, connection.parser.body)
+        return ready
+
+    def _reject(self, connect, status):
+        """直接回复一个没有 body 的错误响应并关闭连接"""
+        try:
+            connect.send(static_response(status))
+        except OSError:
+            pass
+        self._close(connect)
 
+    def _send(self, connect, event):
         fd = connect.fileno()
         connection = self.conn_pool[fd]
         if not connection.handled:
-            self.handle(connection)
+            connection.handled = True
+            try:
+                self.handle(connection)
+            except HTTPParseError as error:
+                self._reject(connect, error.status)
+                return
+            except Exception:
+                logging.exception('error while handling request')
+                self._close(connect)
+                return
+
+        queue = connection.write_queue
+        try:
+            self._fill_write_queue(connection)
+        except Exception:
+            logging.exception('error while iterating response body')
+            self._close(connect)
+            return
+        if queue:
+            try:
+                byteswritten = connect.sendmsg(list(itertools.islice(queue, self.IOV_MAX)))
+            except BlockingIOError:
+                return
+            except OSError:
+                self._close(connect)
+                return
+            if byteswritten:
+                connection.bytes_sent += byteswritten
+                self._consume_write_queue(queue, byteswritten)
+                self._set_timeout(connect, connection, self.WRITE_TIMEOUT)
+
+        if not queue and connection.file is not None:
+            if not self._sendfile(connect, connection):
+                return
 
-        byteswritten = connect.send(connection.response)
-        if byteswritten:
-            connection.response = connection.response[byteswritten:]
+        if not queue and connection.body_iter is None:
+            self._finish(connect, connection)
 
-        if not len(connection.response):
+    def _sendfile(self, connect, connection):
+        """响应头发完后用 sendfile 发送文件, 只发出一部分时记下偏移, 等下一次可写; 发完返回 True"""
+        in_fd, offset, remaining = connection.file
+        try:
+            sent = os.sendfile(connect.fileno(), in_fd, offset, min(remaining, self.SENDFILE_CHUNK))
+        except BlockingIOError:
+            return False
+        except OSError:
+            self._close(connect)
+            return False
+        if not sent:  # 文件在发送过程中被截断, 已经发出的 Content-Length 无法兑现
+            logging.warning('file shrank while sending, closing connection')
+            self._close(connect)
+            return False
+        connection.bytes_sent += sent
+        remaining -= sent
+        self._set_timeout(connect, connection, self.WRITE_TIMEOUT)
+        if remaining:
+            connection.file = (in_fd, offset + sent, remaining)
+            return False
+        connection.file = None
+        self._close_body(connection)
+        return True
+
+    def _fill_write_queue(self, connection):
+        """从应用返回的 body 中取数据放进写队列, 不会一次把整个 body 读进内存"""
+        queue = connection.write_queue
+        while connection.body_iter is not None and len(queue) < self.WRITE_BUFFER_CHUNKS:
+            try:
+                data = next(connection.body_iter)
+            except StopIteration:
+                self._close_body(connection)
+                if connection.chunked:
+                    queue.append(memoryview(b'0\r\n\r\n'))
+                break
+            if not data:
+                continue
+            if connection.chunked:
+                queue.append(memoryview(b'%x\r\n' % len(data)))
+                queue.append(memoryview(data))
+                queue.append(memoryview(CRLF))
+            else:
+                queue.append(memoryview(data))
+
+    @staticmethod
+    def _consume_write_queue(queue, byteswritten):
+        while byteswritten:
+            view = queue[0]
+            if len(view) <= byteswritten:
+                byteswritten -= len(view)
+                queue.popleft()
+            else:  # 只发出去一部分, memoryview 切片不会复制数据
+                queue[0] = view[byteswritten:]
+                byteswritten = 0
+
+    @staticmethod
+    def _close_body(connection):
+        connection.body_iter = None
+        if hasattr(connection.body, 'close'):
+            try:
+                connection.body.close()
+            except Exception:
+                logging.exception('error while closing response body')
+        connection.body = None
+
+    def _finish(self, connect, connection):
+        """响应发送完: keep-alive 的连接回到 READ 状态, 缓冲区里已有下一个请求就继续处理"""
+        self.log_request(connection)
+        if not connection.keep_alive:
             self._close(connect)
+            return
+        connection.reset()
+        ready = self._parse_request(connect, connection)
+        if ready is None:
+            return
+        if ready:  # pipelining, 保持 WRITE 按顺序处理
+            if self.executor is not None or self.async_application:
+                self._submit(connect, connection)
+                return
+            self._set_timeout(connect, connection, self.WRITE_TIMEOUT)
+            return
+        ioloop = self.ioloop
+        ioloop.update_handler(connection.fd, IOLoop.READ)
+        ioloop.replace_handler(connection.fd, self._receive)
+        if connection.request_buffer or connection.parser.state != 'headers':
+            connection.receiving = True
+            self._set_timeout(connect, connection, self.HEADER_TIMEOUT)
+        else:
+            self._set_timeout(connect, connection, self.KEEPALIVE_TIMEOUT)
 
     def _close(self, connect, event=None):
         fd = connect.fileno()
-        connect.shutdown(socket.SHUT_RDWR)
+        try:
+            connect.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         connect.close()
 
-        ioloop = IOLoop.instance()
+        ioloop = self.ioloop
         ioloop.remove_handler(fd)
 
-        del self.conn_pool[fd]
+        connection = self.conn_pool.pop(fd, None)
+        if connection is not None:
+            ioloop.remove_timeout(connection.timeout)
+            self._close_body(connection)
+            if metrics.ENABLED:
+                metrics.CONNECTIONS_ACTIVE.dec(server='mark03')
+            if len(self.conn_pool) < self.MAX_CONNECTIONS:
+                self._resume_accepting()
 
     def serve_forever(self):
-        self.ioloop.add_handler(self.ssocket, self._accept,
-                                IOLoop.READ | IOLoop.ERROR)
+        self._resume_accepting()
         try:
             self.ioloop.start()
         finally:
-            self.ssocket.close()
+            if self.ssocket.fileno() != -1:
+                self.ssocket.close()
+            self.ioloop.close()
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
 
-    def handle(self, connection):
+    def drain(self, timeout=None):
+        """
+        平滑退出: 先把已经在 backlog 中的连接接进来, 然后关闭监听 socket,
+        空闲的 keep-alive 连接直接关闭, 等正在处理的请求完成(最多 timeout 秒)后停止 IOLoop
+        """
+        if self._draining:
+            return
+        while self._accept_batch(self.ssocket, self.ACCEPT_BATCH) == self.ACCEPT_BATCH:
+            pass
+        self._pause_accepting()
+        self._draining = True
+        self.ssocket.close()
+        deadline = self.ioloop.time() + (self.DRAIN_TIMEOUT if timeout is None else timeout)
+        self._check_drained(deadline)
+
+    def _check_drained(self, deadline):
+        for connection in list(self.conn_pool.values()):
+            idle = connection.request is None and not connection.request_buffer \
+                and connection.parser.state == 'headers'
+            if idle:
+                fd_obj = self.ioloop.handlers.get(connection.fd)
+                if fd_obj is not None:
+                    self._close(fd_obj[0])
+        if not self.conn_pool or self.ioloop.time() >= deadline:
+            for fd, (fd_obj, handler) in list(self.ioloop.handlers.items()):
+                if fd in self.conn_pool:
+                    self._close(fd_obj)
+            self.ioloop.stop()
+        else:
+            self.ioloop.call_later(0.1, self._check_drained, deadline)
+
+    def make_start_response(self, connection):
         def start_response(status, response_headers, exc_info=False):
             utc_now = datetime.utcnow().strftime(self.HEADER_DATE_FORMAT)
             connection.headers = response_headers + [
@@ -197,21 +1141,124 @@ class WSGIServer:
                 ('Server', self.SERVER_NAME),
             ]
             connection.status = status
+        return start_response
+
+    def call_application(self, environ, connection):
+        try:
+            return self.application(environ, self.make_start_response(connection))
+        except Exception:
+            return self._application_error(connection)
+
+    async def call_async_application(self, environ, connection):
+        try:
+            return await self.application(environ, self.make_start_response(connection))
+        except Exception:
+            return self._application_error(connection)
+
+    @staticmethod
+    def _application_error(connection):
+        logging.exception('application error')
+        connection.status = '500 Internal Server Error'
+        connection.headers = [('Content-Type', 'text/plain; charset=utf-8')]
+        connection.keep_alive = False
+        return [b'Internal Server Error']
+
+    def handle(self, connection):
+        request_text, request_body = connection.request
+        environ = self.get_environ(request_text, request_body)
+        connection.keep_alive = self.should_keep_alive(environ, connection)
+        body = self.call_application(environ, connection)
+        self.start_body(connection, environ, body)
+
+    def start_body(self, connection, environ, body):
+        connection.body = body
+        try:
+            connection.write_queue.append(memoryview(self.package_response(body, connection, environ)))
+        except Exception:
+            self._close_body(connection)
+            raise
 
-        request_text = ''.join(connection.request_buffer)
-        environ = self.get_environ(request_text)
-        body = self.application(environ, start_response)
-        connection.response = self.package_response(body, connection)
-
-        request_line = request_text.splitlines()[0]
-        logging.info(
-            '%s "%s" %s %s', connection.address[0], request_line,
-            connection.status.split(' ', 1)[0], len(body[0]),
-        )
-        logging.debug('\n' + ''.join(
-            '< {line}\n'.format(line=line)
-            for line in request_text.splitlines()
-        ))
+    def _submit(self, connect, connection):
+        """
+        线程池模式: 应用调用交给线程池; 异步应用: 在 IOLoop 上作为 Task 运行, 不占用线程;
+        执行期间连接不在 selector 中, 结果回到 IOLoop 线程后再切换到 WRITE
+        """
+        if self.async_application:
+            self._spawn(connect, connection)
+            return
+        if self._pending >= self.executor_limit:
+            self._reject(connect, '503 Service Unavailable')
+            return
+        environ = self._detach(connect, connection)
+        if environ is None:
+            return
+        environ['wsgi.multithread'] = True
+        ioloop = self.ioloop
+        self._pending += 1
+        future = self.executor.submit(self.call_application, environ, connection)
+        future.add_done_callback(
+            lambda f: ioloop.add_callback(self._on_application_done, connect, connection, environ, f))
+
+    def _detach(self, connect, connection):
+        """
+        构造 environ, 然后把连接移出 selector 并取消超时, 返回 environ;
+        出错时回复 400 并关闭连接, 返回 None, 连接不会留在 conn_pool 里没人管
+        """
+        try:
+            request_text, request_body = connection.request
+            environ = self.get_environ(request_text, request_body)
+            connection.keep_alive = self.should_keep_alive(environ, connection)
+            ioloop = self.ioloop
+            ioloop.remove_handler(connection.fd)
+            ioloop.remove_timeout(connection.timeout)
+            connection.timeout = None
+            connection.handled = True
+        except Exception:
+            logging.exception('error while preparing request')
+            self._reject(connect, '400 Bad Request')
+            return None
+        return environ
+
+    def _spawn(self, connect, connection):
+        environ = self._detach(connect, connection)
+        if environ is None:
+            return
+        ioloop = self.ioloop
+        self._pending += 1
+        task = ioloop.create_task(self.call_async_application(environ, connection))
+        task.add_done_callback(functools.partial(self._on_application_done, connect, connection, environ))
+
+    def _on_application_done(self, connect, connection, environ, future):
+        self._pending -= 1
+        body = future.result()  # call_application 自己处理了异常
+        if self.conn_pool.get(connection.fd) is not connection:  # 执行期间连接已经关闭
+            if hasattr(body, 'close'):
+                body.close()
+            return
+        try:
+            self.start_body(connection, environ, body)
+        except Exception:
+            logging.exception('error while packaging response')
+            self._close(connect)
+            return
+        self.ioloop.add_handler(connect, self._send, IOLoop.WRITE)
+        self._set_timeout(connect, connection, self.WRITE_TIMEOUT)
+
+    def log_request(self, connection):
+        status = connection.status.split(' ', 1)[0]
+        if metrics.ENABLED:
+            metrics.REQUESTS_TOTAL.inc(server='mark03', status=status)
+        request_line = connection.request[0].split('\r\n', 1)[0]
+        logging.info('%s "%s" %s %s', connection.address[0], request_line, status, connection.bytes_sent)
+
+    def should_keep_alive(self, environ, connection):
+        """HTTP/1.1 默认 keep-alive, 除非 Connection: close; HTTP/1.0 需要显式 Connection: keep-alive"""
+        if self._draining or connection.requests_handled + 1 >= self.MAX_KEEPALIVE_REQUESTS:
+            return False
+        header = environ.get('HTTP_CONNECTION', '').lower()
+        if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+            return 'close' not in header
+        return 'keep-alive' in header
 
     @classmethod
     def parse_request_buffer(cls, text):
@@ -224,39 +1271,235 @@ class WSGIServer:
         else:
             path, query_string = path, ''
 
-        return {
+        request_data = {
             'PATH_INFO': path,
             'REQUEST_METHOD': request_method,
             'SERVER_PROTOCOL': request_version,
             'QUERY_STRING': query_string,
         }
+        for line in content_lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                continue
+            name = name.strip().upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            request_data[name] = value.strip()
+        return request_data
 
-    def get_environ(self, request_text):
+    def get_environ(self, request_text, body=b''):
         request_data = self.parse_request_buffer(request_text)
-        scheme = request_data['SERVER_PROTOCOL'].split('/')[1].lower(),
+        if 'chunked' in request_data.get('HTTP_TRANSFER_ENCODING', '').lower():
+            # 已经解码了 chunked body, 对应用来说就是普通的定长 body
+            del request_data['HTTP_TRANSFER_ENCODING']
+            request_data['CONTENT_LENGTH'] = str(len(body))
         environ = {
             'wsgi.version': (1, 0),
-            'wsgi.url_scheme': scheme,
-            'wsgi.input': StringIO(request_text),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BytesIO(body),
             'wsgi.errors': sys.stderr,
-            'wsgi.multithread': False,
-            'wsgi.multiprocess': False,
+            'wsgi.multithread': self.multithread,
+            'wsgi.multiprocess': self.multiprocess,
             'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
             'SERVER_NAME': self.server_name,
-            'SERVER_PORT': self.server_port,
+            'SERVER_PORT': str(self.server_port),
         }
         environ.update(request_data)
         return environ
 
-    def package_response(self, body, connection):
+    def package_response(self, body, connection, environ):
+        """
+        生成响应头, body 交给写队列边迭代边发送:
+        长度已知时带 Content-Length, 未知时 HTTP/1.1 用 chunked 编码, HTTP/1.0 发送完关闭连接
+        """
+        file_info = self.prepare_file(body, connection, environ)
         response = 'HTTP/1.1 {status}\r\n'.format(status=connection.status)
+        has_length = False
         for header in connection.headers:
+            name = header[0].lower()
+            if name == 'content-length':
+                if file_info is not None:  # 以实际要发送的文件区间为准
+                    continue
+                has_length = True
+            elif name == 'connection':
+                if header[1].lower() == 'close':  # 应用要求关闭连接
+                    connection.keep_alive = False
+                continue
             response += '{0}: {1}\r\n'.format(*header)
+
+        no_body = environ['REQUEST_METHOD'] == 'HEAD' or connection.status[:3] in ('204', '304')
+        if file_info is not None:
+            response += 'Content-Length: {0}\r\n'.format(file_info[2])
+            has_length = True
+        if not has_length and connection.status[:3] not in ('204', '304'):
+            if isinstance(body, (list, tuple)):
+                response += 'Content-Length: {0}\r\n'.format(sum(map(len, body)))
+            elif no_body:
+                connection.keep_alive = False
+            elif environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                connection.chunked = True
+                response += 'Transfer-Encoding: chunked\r\n'
+            else:  # HTTP/1.0 只能用关闭连接表示响应结束
+                connection.keep_alive = False
+        response += 'Connection: {0}\r\n'.format('keep-alive' if connection.keep_alive else 'close')
         response += '\r\n'
-        for data in body:
-            response += data
-        logging.debug('\n' + ''.join(
-            '> {line}\n'.format(line=line)
-            for line in response.splitlines()
-        ))
-        return response
+        if metrics.sample_debug():
+            logging.debug('\n' + ''.join(
+                '< {line}\n'.format(line=line)
+                for line in connection.request[0].splitlines()
+            ) + ''.join(
+                '> {line}\n'.format(line=line)
+                for line in response.splitlines()
+            ))
+
+        if no_body or (file_info is not None and not file_info[2]):
+            self._close_body(connection)
+        elif file_info is not None:
+            connection.file = file_info
+        else:
+            connection.body_iter = iter(body)
+        return response.encode('latin-1')
+
+    def prepare_file(self, body, connection, environ):
+        """
+        body 是指向普通文件的 FileWrapper 时返回 sendfile 需要的 (文件描述符, 偏移, 长度), 否则返回 None;
+        处理单个区间的 Range 请求: 改写状态为 206 并加上 Content-Range, 区间不可满足时回复 416
+        """
+        if not isinstance(body, FileWrapper) or connection.status[:3] != '200':
+            return None
+        try:
+            in_fd = body.fileno()
+            file_stat = os.fstat(in_fd)
+            offset = body.filelike.tell()
+        except (AttributeError, OSError, ValueError):
+            return None
+        if not stat.S_ISREG(file_stat.st_mode):  # 只对普通文件 sendfile
+            return None
+        size = max(0, file_stat.st_size - offset)
+        if not self.SUPPORT_RANGE:
+            return in_fd, offset, size
+
+        connection.headers.append(('Accept-Ranges', 'bytes'))
+        range_header = environ.get('HTTP_RANGE')
+        if not range_header or not self._if_range_matches(environ.get('HTTP_IF_RANGE'), connection.headers):
+            return in_fd, offset, size
+        try:
+            byte_range = parse_range(range_header, size)
+        except HTTPParseError as error:
+            connection.status = error.status
+            connection.headers.append(('Content-Range', 'bytes */{0}'.format(size)))
+            return in_fd, offset, 0
+        if byte_range is None:
+            return in_fd, offset, size
+        start, stop = byte_range
+        connection.status = '206 Partial Content'
+        connection.headers.append(('Content-Range', 'bytes {0}-{1}/{2}'.format(start, stop - 1, size)))
+        return in_fd, offset + start, stop - start
+
+    @staticmethod
+    def _if_range_matches(if_range, headers):
+        """If-Range 和响应的 ETag 或 Last-Modified 完全一致时 Range 才生效"""
+        if not if_range:
+            return True
+        for name, value in headers:
+            if name.lower() in ('etag', 'last-modified') and value == if_range:
+                return True
+        return False
+
+
+class PreforkLoopMaster(PreforkMaster):
+    """
+    多进程模式: 复用 mark02 的 PreforkMaster 看护 worker 进程(崩溃重启, SIGHUP 平滑重启),
+    每个 worker 进程有自己的 IOLoop 和 SO_REUSEPORT 监听 socket, SIGTERM 时平滑退出
+    """
+    def __init__(self, server_address, application, workers, server_kwargs=None):
+        super(PreforkLoopMaster, self).__init__(server_address, application, workers, reuse_port=True)
+        self.server_kwargs = server_kwargs or {}
+
+    def create_server(self):
+        server = WSGIServer(self.server_address, ioloop=IOLoop.current(), reuse_port=True, **self.server_kwargs)
+        server.multiprocess = True
+        server.set_app(self.application)
+        return server
+
+    def worker_main(self):
+        server = self.create_server()
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: server.ioloop.add_callback_from_signal(server.drain))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C 由 master 统一处理
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        server.serve_forever()
+
+
+class ThreadLoopSupervisor:
+    """
+    多线程模式: 每个线程一个 IOLoop 和一个 SO_REUSEPORT 监听 socket,
+    受 GIL 限制, 适合 I/O 为主或者应用调用会释放 GIL 的场景;
+    线程异常退出后重新启动, SIGTERM/SIGINT 时所有 loop 平滑退出
+    """
+    check_interval = 0.5
+
+    def __init__(self, server_address, application, workers, server_kwargs=None):
+        self.server_address = server_address
+        self.application = application
+        self.worker_count = workers
+        self.server_kwargs = server_kwargs or {}
+        self.servers = [None] * workers
+        self.threads = [None] * workers
+        self._running = False
+
+    def create_server(self, index):
+        server = WSGIServer(self.server_address, ioloop=IOLoop(), reuse_port=True, **self.server_kwargs)
+        server.multithread = True
+        server.set_app(self.application)
+        self.servers[index] = server
+        return server
+
+    def spawn_worker(self, index):
+        server = self.create_server(index)
+        thread = threading.Thread(target=server.serve_forever, name='ioloop-%d' % index, daemon=True)
+        thread.start()
+        return thread
+
+    def serve_forever(self):
+        self._running = True
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._handle_stop)
+            signal.signal(signal.SIGINT, self._handle_stop)
+        self.threads = [self.spawn_worker(index) for index in range(self.worker_count)]
+        try:
+            while self._running:
+                for index, thread in enumerate(self.threads):
+                    if not thread.is_alive():
+                        logging.warning('ioloop thread %s exited, restarting', thread.name)
+                        self.threads[index] = self.spawn_worker(index)
+                time.sleep(self.check_interval)
+        finally:
+            for server in self.servers:
+                server.ioloop.add_callback(server.drain)
+            for thread in self.threads:
+                thread.join()
+
+    def shutdown(self):
+        self._running = False
+
+    def _handle_stop(self, signum, frame):
+        self._running = False
+
+
+def make_server(server_address, application, workers=0, mode='process', **server_kwargs):
+    """
+    workers 为 0 时返回单个 WSGIServer;
+    大于 0 时启动 workers 个 IOLoop(mode='process' 多进程, mode='thread' 多线程), 需要指定固定端口
+    返回的对象都用 serve_forever 启动
+    """
+    if not workers:
+        server = WSGIServer(server_address, **server_kwargs)
+        server.set_app(application)
+        return server
+    if mode == 'process':
+        return PreforkLoopMaster(server_address, application, workers, server_kwargs)
+    if mode == 'thread':
+        return ThreadLoopSupervisor(server_address, application, workers, server_kwargs)
+    raise ValueError('mode must be "process" or "thread", not %r' % mode)
@@ -2,12 +2,39 @@
 py回炉计划,用来学习class类的,使用类的一些高级特性实现一个ORM
 """
 
+import time
+import queue
+import sqlite3
+import collections
+import functools
+import itertools
+import threading
+from contextlib import contextmanager
+
 
 class Field(object):
-    __slots__ = ('max_length',)
+    __slots__ = ('max_length', 'primary_key', 'index', 'unique')
+    column_type = None
 
-    def __init__(self, max_length):
+    def __init__(self, max_length, primary_key=False, index=False, unique=False):
         self.max_length = max_length
+        self.primary_key = primary_key
+        self.index = index  # 建表时给这一列建索引
+        self.unique = unique  # 建唯一索引
+
+    def ddl(self, name):
+        """建表语句中这一列的定义"""
+        sql = '%s %s' % (name, self.column_type % {'max_length': self.max_length})
+        if self.primary_key:
+            sql += ' PRIMARY KEY'
+        return sql
+
+    def check_source(self, name, model_name):
+        """
+        这一列的校验代码(几行 Python 源码), ModelMetaclass 把所有列的校验拼成一个 validate 函数,
+        校验前变量 v 是这一列的值, 值为 None 时不校验
+        """
+        return []
 
     def __str__(self):
         return '<%s>' % self.__class__.__name__
@@ -16,13 +43,313 @@ class Field(object):
 
 
 class StringField(Field):
-    def __init__(self, max_length=32):
-        super(StringField, self).__init__(max_length)
+    __slots__ = ()
+    column_type = 'VARCHAR(%(max_length)d)'
+
+    def __init__(self, max_length=32, primary_key=False, index=False, unique=False):
+        super(StringField, self).__init__(max_length, primary_key, index, unique)
+
+    def check_source(self, name, model_name):
+        return [
+            'if v.__class__ is not str and not isinstance(v, str):',
+            '    raise TypeError("%s.%s must be str, not %%s" %% type(v).__name__)' % (model_name, name),
+            'if len(v) > %d:' % self.max_length,
+            '    raise ValueError("%s.%s is longer than %d characters")' % (model_name, name, self.max_length),
+        ]
 
 
 class IntegerField(Field):
-    def __init__(self, max_length=32):
-        super(IntegerField, self).__init__(max_length)
+    __slots__ = ()
+    column_type = 'INTEGER'  # INTEGER PRIMARY KEY 是 rowid 的别名, 插入时不传就自动分配
+
+    def __init__(self, max_length=32, primary_key=False, index=False, unique=False):
+        super(IntegerField, self).__init__(max_length, primary_key, index, unique)
+
+    def check_source(self, name, model_name):
+        return [
+            'if v.__class__ is not int and (not isinstance(v, int) or isinstance(v, bool)):',
+            '    raise TypeError("%s.%s must be int, not %%s" %% type(v).__name__)' % (model_name, name),
+        ]
+
+
+class QueryCache(object):
+    """
+    查询结果缓存, 线程安全, 按 (表名, SQL, 参数) 缓存整个结果
+    1.超过 maxsize 条时淘汰最久没用的, 超过 timeout 秒的结果视为过期, timeout 为 None 时不过期
+    2.表上有写操作时 invalidate(table) 删除这张表的全部结果, 并把这张表的版本号加一,
+      查询开始时记下版本号, 写回时版本号变了就丢弃, 避免查询期间发生的写入被旧结果覆盖
+    3.超过 max_rows 行的结果不缓存
+    """
+    def __init__(self, maxsize=1024, timeout=60, max_rows=1000):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self._entries = collections.OrderedDict()  # {(表名, sql, 参数): (过期时间, 结果)}
+        self._tables = collections.defaultdict(set)  # {表名: 缓存的 key}
+        self._generations = collections.defaultdict(int)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.invalidations = self.evictions = 0
+
+    def generation(self, table):
+        return self._generations[table]
+
+    def get(self, key):
+        """key 的第一项是表名; 没有缓存或者已经过期时返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._discard(key)
+            self.misses += 1
+            return None
+
+    def set(self, key, value, generation):
+        with self._lock:
+            if self._generations[key[0]] != generation:  # 查询期间表被改过
+                return
+            expires = None if self.timeout is None else time.monotonic() + self.timeout
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            self._tables[key[0]].add(key)
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _discard(self, key):
+        del self._entries[key]
+        keys = self._tables.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._tables[key[0]]
+
+    def invalidate(self, table):
+        with self._lock:
+            self._generations[table] += 1
+            self.invalidations += 1
+            for key in self._tables.pop(table, ()):
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            for table in list(self._tables):
+                self._generations[table] += 1
+            self._entries.clear()
+            self._tables.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0,
+                    'size': len(self._entries), 'invalidations': self.invalidations, 'evictions': self.evictions}
+
+
+class SQLiteDatabase(object):
+    """
+    SQLite 后端, 线程安全的连接池
+    1.连接按需创建, 最多 pool_size 个, 用完放回池中, 池空时等待其他线程归还
+    2.每个连接都有 sqlite3 自带的预编译语句缓存, 大小由 cached_statements 控制
+    3.':memory:' 会改用共享缓存的内存数据库, 池中所有连接看到同一个库;
+      共享缓存的表锁不会按 timeout 等待, 一个连接在事务或者游标中时其他连接读写这张表会直接报
+      database table is locked, 所以内存库的 pool_size 固定为 1, 多个线程排队使用这一个连接
+    4.transaction() 把连接绑定到当前线程, 事务中 ORM 的所有操作都走这个连接, 嵌套时用 savepoint;
+      pinned() 同样绑定连接但不开事务, QuerySet 迭代期间用它, 循环体里的 save() 和游标用同一个连接, 不会锁表
+    5.cache 传入 QueryCache 时缓存 QuerySet 的查询结果, 模型的写操作会自动让这张表的缓存失效;
+      绕过 ORM 直接 execute 写表时需要自己调用 db.invalidate(table)
+    """
+    _memory_ids = itertools.count()
+
+    def __init__(self, database=':memory:', pool_size=5, cached_statements=128, timeout=30, cache=None,
+                 **connect_kwargs):
+        self.uri = connect_kwargs.pop('uri', False)
+        self.database = database
+        if database == ':memory:':
+            self.database = 'file:mark04-memory-%d?mode=memory&cache=shared' % next(self._memory_ids)
+            self.uri = True
+            pool_size = 1
+        self.pool_size = pool_size
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+        self.cache = cache
+        self._idle = queue.LifoQueue()  # 后进先出, 热的连接优先复用
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()  # 当前线程绑定的连接和持有者个数, 事务的嵌套层数
+        self._keeper = self._connect() if database == ':memory:' else None  # 共享内存库在最后一个连接关闭时销毁
+
+    def _connect(self):
+        connection = sqlite3.connect(self.database, timeout=self.timeout, uri=self.uri,
+                                     cached_statements=self.cached_statements,
+                                     check_same_thread=False,  # 连接会在线程之间传递, 但同一时间只有一个线程使用
+                                     isolation_level=None, **self.connect_kwargs)  # 自动提交, 事务自己控制
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.pool_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError('no connection available in pool after %s seconds' % self.timeout)
+
+    def release(self, connection):
+        if connection.in_transaction:  # 出错没有提交的事务不能带回池中
+            connection.rollback()
+        self._idle.put(connection)
+
+    def _bound(self):
+        """当前线程绑定的连接(事务或者 pinned() 中), 没有时为 None"""
+        return getattr(self._local, 'bound', None)
+
+    def _hold(self):
+        """
+        把连接绑定到当前线程, 返回这个连接; transaction() 和 pinned() 共用一个引用计数,
+        两者的 with 块可以交错退出, 最后一个退出的才把连接还回池中
+        """
+        local = self._local
+        if not getattr(local, 'holders', 0):
+            local.bound = self.acquire()
+            local.holders = 0
+        local.holders += 1
+        return local.bound
+
+    def _unhold(self):
+        local = self._local
+        local.holders -= 1
+        if not local.holders:
+            connection, local.bound = local.bound, None
+            self.release(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self._bound()
+        if connection is not None:  # 当前线程在事务中或者固定了连接, 使用同一个连接
+            yield connection
+            return
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    @contextmanager
+    def transaction(self):
+        """with db.transaction(): ... 正常退出时提交, 抛异常时回滚, 可以嵌套"""
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            connection = self._hold()
+            savepoint = None
+            begin, commit, rollback = ('begin',), ('commit',), ('rollback',)
+        else:
+            connection = self._bound()
+            savepoint = 'sp%d' % depth
+            begin, commit = ('savepoint ' + savepoint,), ('release ' + savepoint,)
+            rollback = ('rollback to ' + savepoint, 'release ' + savepoint)
+        self._local.depth = depth + 1
+        if depth == 0:
+            self._local.dirty = set()  # 事务中写过的表
+        try:
+            connection.execute(*begin)
+            try:
+                yield connection
+            except BaseException:
+                for sql in rollback:
+                    connection.execute(sql)
+                raise
+            connection.execute(*commit)
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                self._unhold()
+                if self.cache is not None:  # 事务结束后其他线程才看得到修改, 这期间可能又缓存了旧结果
+                    for table in self._local.dirty:
+                        self.cache.invalidate(table)
+                self._local.dirty = None
+
+    @contextmanager
+    def pinned(self):
+        """在 with 块中当前线程的所有操作(包括 transaction())都使用同一个连接, 可以嵌套"""
+        connection = self._hold()
+        try:
+            yield connection
+        finally:
+            self._unhold()
+
+    def in_transaction(self):
+        return getattr(self._local, 'depth', 0) > 0
+
+    def invalidate(self, table):
+        """table 的数据变了, 删除它的缓存结果"""
+        if self.cache is None:
+            return
+        self.cache.invalidate(table)
+        if self.in_transaction():
+            self._local.dirty.add(table)
+
+    def execute(self, sql, args=()):
+        """执行一条写语句, 返回 cursor(带 lastrowid 和 rowcount)"""
+        with self.connection() as connection:
+            return connection.execute(sql, args)
+
+    def executemany(self, sql, rows):
+        """rows 可以是生成器, 返回影响的总行数"""
+        with self.connection() as connection:
+            return connection.executemany(sql, rows).rowcount
+
+    def fetchall(self, sql, args=()):
+        with self.connection() as connection:
+            return connection.execute(sql, args).fetchall()
+
+    def fetchone(self, sql, args=()):
+        with self.connection() as connection:
+            return connection.execute(sql, args).fetchone()
+
+    def create_table(self, model):
+        """建表以及 index=True/unique=True 的列上的索引, 已经存在的跳过"""
+        with self.transaction():
+            self.execute(model.__create_table__)
+            for sql in model.__create_indexes__:
+                self.execute(sql)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+        if self._keeper is not None:
+            self._keeper.close()
+            self._keeper = None
+
+
+def _compile_function(source, name, namespace):
+    """执行生成的函数源码, 返回函数对象"""
+    namespace = dict(namespace)
+    exec(compile(source, '<mark04 %s>' % name, 'exec'), namespace)
+    return namespace[name]
 
 
 class ModelMetaclass(type):
@@ -46,8 +373,62 @@ class ModelMetaclass(type):
                 mappings[k] = v
         for k in mappings.keys():
             attrs.pop(k)
+        table = attrs.get('__table__') or name.lower()  # 默认表名和类名一致
+        primary_key = None
+        for k, v in mappings.items():
+            if v.primary_key:
+                if primary_key is not None:
+                    raise TypeError('%s has more than one primary key' % name)
+                primary_key = k
+        if primary_key is None and 'id' in mappings:  # 没有显式指定时 id 作为主键
+            primary_key = 'id'
+            mappings['id'].primary_key = True
+        fields = [k for k in mappings if k != primary_key]  # 除主键外的列
+
         attrs['__mappings__'] = mappings  # 保存属性和列的映射关系
-        attrs['__table__'] = name.lower()  # 假设表名和类名一致
+        attrs['__table__'] = table
+        attrs['__primary_key__'] = primary_key
+        attrs['__fields__'] = fields
+        # SQL 只在创建类时拼一次, save/update/delete 直接使用
+        attrs['__create_table__'] = 'create table if not exists %s (%s)' % (
+            table, ', '.join(v.ddl(k) for k, v in mappings.items()))
+        attrs['__create_indexes__'] = [
+            'create %sindex if not exists %s_%s_%s on %s (%s)' % (
+                'unique ' if v.unique else '', 'ux' if v.unique else 'ix', table, k, table, k)
+            for k, v in mappings.items() if (v.index or v.unique) and not v.primary_key]
+        attrs['__select__'] = 'select %s from %s' % (', '.join(mappings), table)
+        attrs['__insert__'] = 'insert into %s (%s) values (%s)' % (
+            table, ', '.join(mappings), ', '.join('?' * len(mappings)))
+        attrs['__insert_auto__'] = 'insert into %s (%s) values (%s)' % (  # 主键由数据库分配
+            table, ', '.join(fields), ', '.join('?' * len(fields)))
+        if primary_key is not None:
+            attrs['__update__'] = 'update %s set %s where %s = ?' % (
+                table, ', '.join('%s = ?' % k for k in fields), primary_key)
+            attrs['__delete__'] = 'delete from %s where %s = ?' % (table, primary_key)
+            attrs['__select_pk__'] = '%s where %s = ?' % (attrs['__select__'], primary_key)
+            attrs['__upsert__'] = '%s on conflict(%s) do update set %s' % (
+                attrs['__insert__'], primary_key, ', '.join('%s = excluded.%s' % (k, k) for k in fields))
+        attrs['__update_sql__'] = {}  # 只更新部分列时的 SQL, 按列组合缓存
+
+        # 实例只用 __slots__ 保存列的值, 没有 __dict__; __init__ 和 validate 按列生成代码, 只编译一次
+        # __loaded__ 是 only() 查询时加载了的列, None 表示所有列都有值
+        attrs['__slots__'] = tuple(mappings) + ('__loaded__',)
+        attrs['__init__'] = _compile_function(
+            'def __init__(self%s):\n%s    self.__loaded__ = None\n' % (
+                ''.join(', %s=None' % k if i else ', *, %s=None' % k for i, k in enumerate(mappings)),
+                ''.join('    self.%s = %s\n' % (k, k) for k in mappings)),
+            '__init__', {})
+        lines = ['def validate(self):']
+        for k, v in mappings.items():
+            check = v.check_source(k, name)
+            if check:
+                lines.append('    v = self.%s' % k)
+                lines.append('    if v is not None:')
+                lines.extend('        ' + line for line in check)
+        lines.append('    return self')
+        attrs['validate'] = _compile_function('\n'.join(lines) + '\n', 'validate', {})
+        attrs['__row__'] = collections.namedtuple(name + 'Row', mappings)  # 只读结果的元组类型
+        attrs['__loaders__'] = {}  # 按查询的列生成的行 -> 实例转换函数
         """
         关于 type() 和 type.__new__()
         通过type()函数创建的类和直接写class是完全一样的。
@@ -56,82 +437,551 @@ class ModelMetaclass(type):
         return type.__new__(cls, name, bases, attrs)  # type()动态创建class
 
 
-class Model(dict, metaclass=ModelMetaclass):
+class Model(metaclass=ModelMetaclass):
     """
     metaclass指示Py解释器在创建Model时,要通过ModelMetaclass.__new__()来创建
+    子类的实例用 __slots__ 保存列的值, 属性访问就是普通的 slot 读写;
+    to_dict() 导出成 dict, 另外保留 obj['name'] / obj.get('name') 的写法
     """
-    def __init__(self, **kw):
-        super(Model, self).__init__(**kw)
+    __slots__ = ()
+    __database__ = None  # Model.bind(db) 绑定后所有模型共用, 子类也可以单独绑定
 
-    def __getattr__(self, key):  # 动态返回属性
-        try:
-            return self[key]
-        except KeyError:
-            raise AttributeError(r"'Model' object has no attribute '%s'" % key)
+    @classmethod
+    def _row_class(cls, columns):
+        """只读结果用的 namedtuple, 查询了全部列时就是 __row__"""
+        if columns == cls.__row__._fields:
+            return cls.__row__
+        key = ('row',) + columns
+        row_class = cls.__loaders__.get(key)
+        if row_class is None:
+            row_class = cls.__loaders__[key] = collections.namedtuple(cls.__name__ + 'Row', columns, rename=True)
+        return row_class
+
+    @classmethod
+    def _loader(cls, columns):
+        """返回把查询结果的一行(按 columns 排列的元组)直接填进 slot 的函数, 不经过 __init__"""
+        loader = cls.__loaders__.get(columns)
+        if loader is None:
+            unknown = [c for c in columns if c not in cls.__mappings__]
+            if unknown:
+                raise ValueError('columns %s are not fields of %s, use values_list() instead'
+                                 % (', '.join(unknown), cls.__name__))
+            lines = ['def load(row):', '    self = new(cls)']
+            if columns:
+                lines.append('    %s, = row' % ', '.join('self.' + c for c in columns))
+            lines.extend('    self.%s = None' % k for k in cls.__mappings__ if k not in columns)
+            lines.append('    self.__loaded__ = loaded')
+            lines.append('    return self')
+            loaded = None if set(cls.__mappings__) <= set(columns) else frozenset(columns)
+            loader = cls.__loaders__[columns] = _compile_function(
+                '\n'.join(lines) + '\n', 'load', {'new': object.__new__, 'cls': cls, 'loaded': loaded})
+        return loader
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__mappings__}
+
+    def __getitem__(self, key):
+        if key not in self.__mappings__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__mappings__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__mappings__ else default
+
+    def keys(self):
+        return self.__mappings__.keys()
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return all(getattr(self, k) == getattr(other, k) for k in self.__mappings__)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % (k, getattr(self, k)) for k in self.__mappings__))
+
+    @classmethod
+    def bind(cls, database):
+        cls.__database__ = database
 
-    def __setattr__(self, key, value):
-        self[key] = value
+    @classmethod
+    def _db(cls):
+        if cls.__database__ is None:
+            raise RuntimeError('%s is not bound to a database, call Model.bind(db) first' % cls.__name__)
+        return cls.__database__
+
+    @classmethod
+    def create_table(cls):
+        cls._db().create_table(cls)
 
     def save(self):
-        fields = []
-        params = []
-        args = []
-        for k, v in self.__mappings__.items():
-            # fields.append(v.name)
-            fields.append(k)
-            params.append('?')
-            args.append(getattr(self, k, None))
-        sql = """insert into %s (%s) values (%s)""" % (self.__table__, ','.join(fields), ','.join(params))
-        print('SQL: %s' % sql)
-        print('ARGS: %s' % str(args))
-
-    def query(self, sql):
-        # 假设结果为
-        print(sql)
-        return QueryDict([dict(id=1, name='wang1', email='xxx1@qq.com', password='123456'),
-                          dict(id=2, name='wang2', email='xxx2@qq.com', password='123456')])
-
-
-class QueryDict:
-    def __init__(self, result):
-        self.index = 0
-        if isinstance(result, dict):
-            self.result = [result]
-        if isinstance(result, list):
-            self.result = result
-
-    def __getitem__(self, n):  # 把对象和实例当作list
-        if isinstance(n, int):  # n是索引
-            return self.result[n]
-        if isinstance(n, slice):  # n是切片
-            return self.result[n.start: n.stop]
-
-    def __iter__(self):  # 让对象和实例可以被迭代
-        return self  # 实例本身就是迭代对象，故返回自己
-
-    def __next__(self):  # 这地方有点bug啊,不能显示第一个
-        self.index += 1
-        if self.index >= len(self.result):
-            raise StopIteration()
-        return self.result[self.index]
+        """主键为空时插入并取回数据库分配的主键, 否则按主键更新, 没有这一行时插入"""
+        self.validate()
+        pk = self.__primary_key__
+        pk_value = self.get(pk) if pk is not None else None
+        db = self._db()
+        if pk_value is None:
+            cursor = db.execute(self.__insert_auto__, [self.get(k) for k in self.__fields__])
+            if pk is not None:
+                self[pk] = cursor.lastrowid
+        elif not self.update():
+            db.execute(self.__insert__, [self.get(k) for k in self.__mappings__])
+        db.invalidate(self.__table__)
+        return self
+
+    def _dirty_fields(self):
+        """
+        要写回的列(不含主键): 完整的实例是全部列;
+        only() 加载的实例只有查询过的列和之后赋了非 None 值的列, 没加载的列不会被 None 覆盖
+        """
+        loaded = self.__loaded__
+        if loaded is None:
+            return None
+        return tuple(k for k in self.__fields__ if k in loaded or getattr(self, k) is not None)
+
+    def update(self):
+        """按主键更新, 返回更新的行数"""
+        self.validate()
+        db = self._db()
+        fields = self._dirty_fields()
+        if fields is None:
+            sql, fields = self.__update__, self.__fields__
+        else:
+            sql = self._update_sql(fields)
+        cursor = db.execute(sql, [self.get(k) for k in fields] + [self[self.__primary_key__]])
+        db.invalidate(self.__table__)
+        return cursor.rowcount
+
+    @staticmethod
+    def _check_complete(row, method):
+        if isinstance(row, Model) and row.__loaded__ is not None:
+            raise ValueError('%r was loaded with only(), %s() would overwrite the columns not loaded with None; '
+                             'use bulk_update(fields=...) instead' % (row, method))
+
+    def delete(self):
+        db = self._db()
+        cursor = db.execute(self.__delete__, (self[self.__primary_key__],))
+        db.invalidate(self.__table__)
+        return cursor.rowcount
+
+    @classmethod
+    def atomic(cls):
+        """with User.atomic(): ... 等同于 db.transaction()"""
+        return cls._db().transaction()
+
+    @staticmethod
+    def _batches(iterable, batch_size):
+        iterator = iter(iterable)
+        while True:
+            batch = list(itertools.islice(iterator, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    @classmethod
+    def bulk_save(cls, iterable, batch_size=500):
+        """
+        批量保存 Model 实例(保存前 validate)或者 dict, 每 batch_size 行一次 executemany, 整体在一个事务中;
+        主键为空的行插入, 插入的 Model 实例会回填主键; 有主键的行按主键插入或更新; 返回写入的行数
+        """
+        pk = cls.__primary_key__
+        count = 0
+        with cls.atomic() as connection:
+            for batch in cls._batches(iterable, batch_size):
+                for row in batch:
+                    if isinstance(row, Model):
+                        cls._check_complete(row, 'bulk_save')
+                        row.validate()
+                new = [row for row in batch if pk is None or row.get(pk) is None]
+                existing = [row for row in batch if pk is not None and row.get(pk) is not None]
+                if new:
+                    count += connection.executemany(
+                        cls.__insert_auto__, [[row.get(k) for k in cls.__fields__] for row in new]).rowcount
+                    if pk is not None:  # 同一事务中连续插入, rowid 是连续分配的
+                        last = connection.execute('select last_insert_rowid()').fetchone()[0]
+                        for offset, row in enumerate(reversed(new)):
+                            if isinstance(row, Model):
+                                row[pk] = last - offset
+                if existing:
+                    count += connection.executemany(
+                        cls.__upsert__, [[row.get(k) for k in cls.__mappings__] for row in existing]).rowcount
+            cls._db().invalidate(cls.__table__)
+        return count
+
+    @classmethod
+    def bulk_update(cls, iterable, fields=None, batch_size=500):
+        """按主键批量更新 fields 指定的列(默认全部), 返回更新的行数"""
+        pk = cls.__primary_key__
+        check = fields is None
+        fields = tuple(fields) if fields is not None else tuple(cls.__fields__)
+        sql = cls._update_sql(fields)
+        count = 0
+        with cls.atomic() as connection:
+            for batch in cls._batches(iterable, batch_size):
+                if check:
+                    for row in batch:
+                        cls._check_complete(row, 'bulk_update')
+                count += connection.executemany(sql, [[row.get(k) for k in fields] + [row[pk]]
+                                                      for row in batch]).rowcount
+            cls._db().invalidate(cls.__table__)
+        return count
+
+    @classmethod
+    def _update_sql(cls, fields):
+        """只更新 fields 这几列的 SQL, 按列组合缓存; 没有列时是一个空更新, 只用来判断这一行在不在"""
+        sql = cls.__update_sql__.get(fields)
+        if sql is None:
+            unknown = set(fields) - set(cls.__fields__)
+            if unknown:
+                raise ValueError('unknown fields for %s: %s' % (cls.__name__, ', '.join(sorted(unknown))))
+            pk = cls.__primary_key__
+            assignments = ', '.join('%s = ?' % k for k in fields) or '%s = %s' % (pk, pk)
+            sql = cls.__update_sql__[fields] = 'update %s set %s where %s = ?' % (cls.__table__, assignments, pk)
+        return sql
+
+    @classmethod
+    def bulk_delete(cls, iterable, batch_size=500):
+        """iterable 中可以是 Model 实例, dict 或者直接是主键值, 返回删除的行数"""
+        pk = cls.__primary_key__
+        count = 0
+        with cls.atomic() as connection:
+            for batch in cls._batches(iterable, batch_size):
+                count += connection.executemany(cls.__delete__, [(row[pk] if isinstance(row, (dict, Model)) else row,)
+                                                                 for row in batch]).rowcount
+            cls._db().invalidate(cls.__table__)
+        return count
+
+    @classmethod
+    def get_by_pk(cls, pk_value):
+        row = cls._db().fetchone(cls.__select_pk__, (pk_value,))
+        return cls._loader(tuple(cls.__mappings__))(row) if row is not None else None
+
+    @classmethod
+    def query(cls, sql, args=(), cache=True):
+        """
+        原生 SQL 查询, 返回惰性的 QuerySet, 迭代时才执行;
+        结果缓存按这个模型的表失效, sql 读了其他表时应当传 cache=False
+        """
+        return QuerySet(cls, sql, args, cache=cache)
+
+    @classmethod
+    def all(cls):
+        return QuerySet(cls)
+
+    @classmethod
+    def filter(cls, **lookups):
+        return QuerySet(cls).filter(**lookups)
+
+    @classmethod
+    def exclude(cls, **lookups):
+        return QuerySet(cls).exclude(**lookups)
+
+    @classmethod
+    def order_by(cls, *fields):
+        return QuerySet(cls).order_by(*fields)
+
+
+# filter(name__startswith='wang') 中 __ 后面的查询类型
+LOOKUPS = {
+    'exact': '%s = ?',
+    'ne': '%s != ?',
+    'gt': '%s > ?',
+    'gte': '%s >= ?',
+    'lt': '%s < ?',
+    'lte': '%s <= ?',
+    'contains': "%s like ? escape '\\'",
+    'startswith': "%s like ? escape '\\'",
+    'in': None,
+    'isnull': None,
+}
+
+
+def _like_escape(value):
+    return str(value).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _compile_condition(field, lookup, extra):
+    if lookup == 'isnull':
+        return '%s is %snull' % (field, '' if extra else 'not ')
+    if lookup == 'in':
+        return '%s in (%s)' % (field, ', '.join('?' * extra)) if extra else '0'
+    if lookup == 'exact' and extra:  # field=None
+        return '%s is null' % field
+    return LOOKUPS[lookup] % field
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_query(model, raw_sql, columns, where, ordering):
+    """
+    把查询的"形状"(列, 条件的字段和类型, 排序)编译成带 ? 占位符的 SQL, 同样形状的查询只编译一次,
+    参数值不在形状里, 由 QuerySet 按同样的顺序收集
+    """
+    source = model.__table__ if raw_sql is None else '(%s)' % raw_sql
+    sql = 'select %s from %s' % (', '.join(columns), source)
+    if where:
+        clauses = []
+        for negate, conditions in where:
+            clause = ' and '.join(_compile_condition(*condition) for condition in conditions)
+            clauses.append('not (%s)' % clause if negate else '(%s)' % clause)
+        sql += ' where ' + ' and '.join(clauses)
+    if ordering:
+        sql += ' order by ' + ', '.join('%s desc' % f[1:] if f.startswith('-') else f for f in ordering)
+    return sql
+
+
+class QuerySet:
+    """
+    惰性查询集, 创建, 过滤和切片都不会执行 SQL, 迭代时才查询:
+    1.结果按 chunk_size 用 fetchmany 分批从游标中取, 不会把整个结果读进内存, 每次迭代重新查询;
+      数据库配置了 QueryCache 时, 完整迭代过的结果和 count()/exists() 会被缓存, no_cache() 关闭
+    2.filter/exclude/order_by/only 返回新的 QuerySet, SQL 按查询形状缓存在 compile_query 中
+    3.qs[a:b] 变成 LIMIT/OFFSET, qs[n] 只取一行, read_only() 返回 namedtuple
+    4.count()/exists() 在数据库里计算, values_list() 直接返回元组, 不创建模型实例
+    原生 SQL 作为子查询, 在外面加过滤, 排序和分页
+    """
+    chunk_size = 500
+
+    def __init__(self, model, sql=None, args=(), limit=None, offset=0, fields=None, flat=False,
+                 where=(), where_args=(), ordering=(), only=None, as_rows=False, cache=True):
+        self.model = model
+        self.sql = sql
+        self.args = tuple(args)
+        self.limit = limit
+        self.offset = offset
+        self.fields = fields  # values_list 指定的列, None 表示返回模型实例
+        self.flat = flat
+        self.where = where  # ((是否取反, ((字段, 查询类型, 形状参数), ...)), ...)
+        self.where_args = where_args
+        self.ordering = ordering
+        self.only_fields = only  # only() 指定的列, 模型实例中其他列为 None
+        self.as_rows = as_rows  # read_only(): 返回 namedtuple 而不是模型实例
+        self.use_cache = cache
+
+    def _clone(self, **kwargs):
+        state = dict(sql=self.sql, args=self.args, limit=self.limit, offset=self.offset,
+                     fields=self.fields, flat=self.flat, where=self.where, where_args=self.where_args,
+                     ordering=self.ordering, only=self.only_fields, as_rows=self.as_rows, cache=self.use_cache)
+        state.update(kwargs)
+        return self.__class__(self.model, **state)
+
+    def _check_field(self, name):
+        if name not in self.model.__mappings__:
+            raise ValueError('%s has no field %r' % (self.model.__name__, name))
+
+    def _add_where(self, negate, lookups):
+        if self.limit is not None or self.offset:
+            raise TypeError('cannot filter a QuerySet once a slice has been taken')
+        conditions, args = [], []
+        for key in sorted(lookups):  # 排序后同样的条件组合得到同样的形状
+            value = lookups[key]
+            name, _, lookup = key.partition('__')
+            lookup = lookup or 'exact'
+            self._check_field(name)
+            if lookup not in LOOKUPS:
+                raise ValueError('unknown lookup %r' % lookup)
+            extra = None
+            if lookup == 'in':
+                value = list(value)
+                extra = len(value)
+                args.extend(value)
+            elif lookup == 'isnull':
+                extra = bool(value)
+            elif lookup == 'exact' and value is None:
+                extra = True
+            elif lookup == 'contains':
+                args.append('%%%s%%' % _like_escape(value))
+            elif lookup == 'startswith':
+                args.append('%s%%' % _like_escape(value))
+            else:
+                args.append(value)
+            conditions.append((name, lookup, extra))
+        if not conditions:
+            return self
+        return self._clone(where=self.where + ((negate, tuple(conditions)),),
+                           where_args=self.where_args + tuple(args))
+
+    def filter(self, **lookups):
+        """filter(name='wang', id__gt=10), 多个条件之间是 and"""
+        return self._add_where(False, lookups)
+
+    def exclude(self, **lookups):
+        return self._add_where(True, lookups)
+
+    def order_by(self, *fields):
+        """order_by('-id', 'name'), - 表示倒序, 替换之前的排序"""
+        for field in fields:
+            self._check_field(field.lstrip('-'))
+        return self._clone(ordering=tuple(fields))
+
+    def only(self, *fields):
+        """只查询部分列, 主键总是会带上"""
+        for field in fields:
+            self._check_field(field)
+        pk = self.model.__primary_key__
+        if pk is not None and pk not in fields:
+            fields = (pk,) + fields
+        return self._clone(only=tuple(fields))
+
+    def read_only(self):
+        """
+        结果用 namedtuple 表示, 比模型实例更省内存, 创建也更快, 但是不能修改和保存;
+        row.name 读取, row._asdict() 导出成 dict
+        """
+        return self._clone(as_rows=True)
+
+    def no_cache(self):
+        """这个查询总是读数据库, 也不写入缓存"""
+        return self._clone(cache=False)
+
+    def _columns(self):
+        if self.fields is not None:
+            return self.fields
+        if self.only_fields is not None:
+            return self.only_fields
+        if self.sql is None:
+            return tuple(self.model.__mappings__)
+        return ('*',)
+
+    def as_sql(self):
+        """返回 (sql, args)"""
+        sql = compile_query(self.model, self.sql, self._columns(), self.where, self.ordering)
+        args = self.args + self.where_args
+        if self.limit is None and not self.offset:
+            return sql, args
+        return '%s limit ? offset ?' % sql, args + (-1 if self.limit is None else self.limit, self.offset)
+
+    def _cache_key(self, sql, args):
+        """返回 (cache, key), 不使用缓存时都是 None"""
+        db = self.model._db()
+        if not self.use_cache or db.cache is None or db.in_transaction():  # 事务中会读到自己还没提交的修改
+            return None, None
+        key = (self.model.__table__, sql, args)
+        try:
+            hash(key)
+        except TypeError:  # 参数不能作为 key
+            return None, None
+        return db.cache, key
+
+    def _converter(self, names):
+        """返回把一批元组转换成结果的函数"""
+        if self.fields is not None:
+            return (lambda rows: (row[0] for row in rows)) if self.flat else iter
+        load = functools.partial(tuple.__new__, self.model._row_class(names)) if self.as_rows \
+            else self.model._loader(names)
+        return functools.partial(map, load)
+
+    def __iter__(self):
+        sql, args = self.as_sql()
+        cache, key = self._cache_key(sql, args)
+        if cache is not None:
+            entry = cache.get(key)
+            if entry is not None:  # 缓存的是原始元组, 每次重新创建实例, 修改实例不会影响缓存
+                names, rows = entry
+                yield from self._converter(names)(rows)
+                return
+            generation = cache.generation(key[0])
+        buffer = [] if cache is not None else None
+        with self.model._db().pinned() as connection:  # 迭代期间当前线程的写操作也走这个连接
+            cursor = connection.cursor()
+            cursor.row_factory = None  # 直接拿元组, 列名从 description 中取一次
+            cursor.execute(sql, args)
+            names = tuple(column[0] for column in cursor.description)
+            convert = self._converter(names)
+            try:
+                while True:
+                    rows = cursor.fetchmany(self.chunk_size)
+                    if not rows:
+                        break
+                    if buffer is not None:
+                        buffer.extend(rows)
+                        if len(buffer) > cache.max_rows:
+                            buffer = None
+                    yield from convert(rows)
+            finally:
+                cursor.close()
+        if buffer is not None:  # 只有完整迭代完才缓存
+            cache.set(key, (names, tuple(buffer)), generation)
+
+    def _fetch_value(self, sql, args):
+        cache, key = self._cache_key(sql, args)
+        if cache is not None:
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[0]
+            generation = cache.generation(key[0])
+        value = self.model._db().fetchone(sql, args)[0]
+        if cache is not None:
+            cache.set(key, (value,), generation)
+        return value
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None or (key.start or 0) < 0 or (key.stop is not None and key.stop < 0):
+                raise ValueError('QuerySet only supports non-negative slices without step')
+            start = key.start or 0
+            limit = None if key.stop is None else max(0, key.stop - start)
+            if self.limit is not None:
+                remaining = max(0, self.limit - start)
+                limit = remaining if limit is None else min(limit, remaining)
+            return self._clone(limit=limit, offset=self.offset + start)
+        if isinstance(key, int):
+            if key < 0:
+                raise ValueError('QuerySet does not support negative indexing')
+            items = list(self[key:key + 1])
+            if not items:
+                raise IndexError('QuerySet index out of range')
+            return items[0]
+        raise TypeError('QuerySet indices must be integers or slices, not %s' % type(key).__name__)
+
+    def first(self):
+        items = list(self[:1])
+        return items[0] if items else None
+
+    def count(self):
+        sql, args = self.as_sql()
+        return self._fetch_value('select count(*) from (%s)' % sql, args)
+
+    def exists(self):
+        sql, args = self[:1].as_sql()
+        return self._fetch_value('select exists(select 1 from (%s))' % sql, args) == 1
+
+    def values_list(self, *fields, flat=False):
+        """返回元组(flat=True 且只有一列时返回单个值), 不指定列时返回所有列"""
+        if flat and len(fields) != 1:
+            raise TypeError('flat=True requires exactly one field')
+        for field in fields:
+            self._check_field(field)
+        return self._clone(fields=tuple(fields) or tuple(self.model.__mappings__), flat=flat)
+
+    def explain(self):
+        """EXPLAIN QUERY PLAN 的结果, 每步一行, 用来确认有没有用上索引"""
+        sql, args = self.as_sql()
+        rows = self.model._db().fetchall('explain query plan ' + sql, args)
+        return '\n'.join(row['detail'] for row in rows)
+
+    def __repr__(self):
+        return '<QuerySet %s %r>' % self.as_sql()
 
 
 class User(Model):
     # 定义类的属性到列的映射：
     id = IntegerField()
-    name = StringField(max_length=16)
+    name = StringField(max_length=16, index=True)
     email = StringField()
     password = StringField()
 
 
 if __name__ == '__main__':
-    db = User()
-    # db.id = 1
-    # db.name = 'wang'
-    # db.email = 'xxx@qq.com'
-    # db.password = '123'
-    # db.save()
-    r = db.query('select * from user')
+    Model.bind(SQLiteDatabase(':memory:'))
+    User.create_table()
+    User(name='wang1', email='xxx1@qq.com', password='123456').save()
+    User(name='wang2', email='xxx2@qq.com', password='123456').save()
+    r = User.query('select * from user')
     print(r[0])
     print(r[1])
     for i in r:
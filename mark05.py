@@ -10,7 +10,15 @@
 
 import os
 import sys
+import time
+import errno
+import pickle
+import select
+import signal
+import struct
 import itertools
+import traceback
+import collections
 
 
 class Popen:
@@ -24,10 +32,52 @@ class Popen:
             if 'random' in sys.modules:
                 import random
                 random.seed()
-            code = process_obj._bootstrap()
-            sys.stdout.flush()
-            sys.stderr.flush()
-            os._exit(code)
+            code = 1
+            try:
+                code = process_obj._bootstrap()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+
+    def poll(self, flag=os.WNOHANG):
+        """回收子进程, 返回退出码(被信号杀死时为负的信号值), 还在运行返回 None"""
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, flag)
+            except ChildProcessError:
+                return None
+            if pid == self.pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if timeout is None:
+            return self.poll(0)
+        deadline = time.monotonic() + timeout
+        delay = 0.0005
+        while True:
+            returncode = self.poll()
+            if returncode is not None:
+                return returncode
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            delay = min(delay * 2, remaining, 0.05)
+            time.sleep(delay)
+
+    def _send_signal(self, sig):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self._send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self._send_signal(signal.SIGKILL)
 
 
 class Process:
@@ -45,6 +95,34 @@ class Process:
             'can only start a process object created by current process'
         self._popen = Popen(self)
 
+    def join(self, timeout=None):
+        """等待子进程退出, 超时返回时进程可能还在运行, 用 is_alive() 判断"""
+        assert self._popen is not None, 'can only join a started process'
+        self._popen.wait(timeout)
+
+    def is_alive(self):
+        if self._popen is None:
+            return False
+        return self._popen.poll() is None
+
+    def terminate(self):
+        if self._popen is not None:
+            self._popen.terminate()
+
+    def kill(self):
+        if self._popen is not None:
+            self._popen.kill()
+
+    @property
+    def pid(self):
+        return self._popen.pid if self._popen is not None else None
+
+    @property
+    def exitcode(self):
+        if self._popen is None:
+            return None
+        return self._popen.poll()
+
     def _bootstrap(self):
         global _current_process
 
@@ -57,12 +135,20 @@ class Process:
             except (OSError, ValueError):
                 pass
             _current_process = self
-            print('child process calling self.run()')
             try:
                 self.run()
                 exitcode = 0
-            finally:
-                pass
+            except SystemExit as error:
+                if error.code is None:
+                    exitcode = 0
+                elif isinstance(error.code, int):
+                    exitcode = error.code
+                else:
+                    sys.stderr.write(str(error.code) + '\n')
+                    exitcode = 1
+            except BaseException:
+                exitcode = 1
+                traceback.print_exc()
         finally:
             pass
         return exitcode
@@ -72,6 +158,407 @@ class Process:
             self._target(*self._args, **self._kwargs)
 
 
+_HEADER = struct.Struct('!Q')
+
+
+def _write_message(fd, obj):
+    """长度 + pickle 数据写进管道"""
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    view = memoryview(_HEADER.pack(len(data)) + data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _read_exactly(fd, size):
+    chunks = []
+    while size:
+        try:
+            chunk = os.read(fd, min(size, 1 << 20))
+        except InterruptedError:
+            continue
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _read_message(fd):
+    """对端关闭时返回 None"""
+    header = _read_exactly(fd, _HEADER.size)
+    if header is None:
+        return None
+    data = _read_exactly(fd, _HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)
+
+
+def _call(task):
+    func, args, kwargs = task
+    return func(*args, **kwargs)
+
+
+class AsyncResult:
+    """apply_async/map_async 的返回值, get() 时由调用线程推动 Pool 的调度"""
+    def __init__(self, pool, callback=None, error_callback=None):
+        self._pool = pool
+        self._callback = callback
+        self._error_callback = error_callback
+        self._ready = False
+        self._success = None
+        self._value = None
+
+    def ready(self):
+        return self._ready
+
+    def successful(self):
+        if not self._ready:
+            raise ValueError('result is not ready')
+        return self._success
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._ready:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return
+            self._pool._pump(remaining)
+
+    def get(self, timeout=None):
+        self.wait(timeout)
+        if not self._ready:
+            raise TimeoutError('result is not ready after %s seconds' % timeout)
+        if not self._success:
+            raise self._value
+        return self._value
+
+    def _set(self, success, value):
+        self._success, self._value, self._ready = success, value, True
+        callback = self._callback if success else self._error_callback
+        if callback is not None:
+            callback(value)
+
+
+class _Worker:
+    """一个 worker 进程和它的两根管道, master 一次只给它一个批次"""
+    def __init__(self, process, task_fd, result_fd):
+        self.process = process
+        self.task_fd = task_fd  # master 写任务
+        self.result_fd = result_fd  # master 读结果
+        self.handler = None  # 正在执行的批次的结果回调, None 表示空闲
+        self.tasks = 0  # 已经完成的批次数
+
+    def close_tasks(self):
+        if self.task_fd is not None:
+            os.close(self.task_fd)
+            self.task_fd = None
+
+    def close(self):
+        """关闭后置为 None, 之后 fork 的子进程不会误关同一个编号的新管道"""
+        self.close_tasks()
+        if self.result_fd is not None:
+            os.close(self.result_fd)
+            self.result_fd = None
+
+
+class _Feeder:
+    """imap 用, 有空闲 worker 时才从 iterable 中取下一批, 不会一次把输入全部读进来"""
+    def __init__(self, func, iterable, chunksize):
+        self.func = func
+        self.iterator = iter(iterable)
+        self.chunksize = chunksize
+        self.results = {}  # {批次序号: (是否成功, 结果列表或异常)}
+        self.sent = 0
+        self.exhausted = False
+
+    def next_task(self):
+        items = list(itertools.islice(self.iterator, self.chunksize))
+        if not items:
+            self.exhausted = True
+            return None
+        index = self.sent
+        self.sent += 1
+        return self.func, items, lambda success, value: self.results.__setitem__(index, (success, value))
+
+
+class Pool:
+    """
+    简易版本的 multiprocessing.Pool, 先 fork 出 processes 个 worker
+    1.每个 worker 有一对管道, 任务按 chunksize 打包成一个批次, pickle 一次发过去, 结果也整批发回来
+    2.master 没有后台线程, 调度都在 _pump 中, 由 get()/迭代结果的线程推动; 只给空闲的 worker 发任务
+    3.worker 退出(管道读到 EOF)后用 waitpid 回收并补一个新的, 它手上的批次以异常结束
+    4.maxtasksperchild: worker 完成这么多个批次后退出, 由新进程替换, 防止内存一直增长
+    任务函数和参数需要能 pickle, 模块级别的函数可以, lambda 不行
+    """
+    def __init__(self, processes=None, initializer=None, initargs=(), maxtasksperchild=None):
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes < 1:
+            raise ValueError('number of processes must be at least 1')
+        if maxtasksperchild is not None and maxtasksperchild < 1:
+            raise ValueError('maxtasksperchild must be a positive int or None')
+        self._processes = processes
+        self._initializer = initializer
+        self._initargs = tuple(initargs)
+        self._maxtasks = maxtasksperchild
+        self._pending = collections.deque()  # 等待空闲 worker 的 (func, items, handler)
+        self._feeders = []
+        self._state = 'run'
+        self._workers = []
+        for _ in range(processes):
+            self._workers.append(self._spawn())
+
+    def _spawn(self):
+        task_r, task_w = os.pipe()
+        result_r, result_w = os.pipe()
+        process = Process(target=self._worker_main, args=(task_r, result_w, (task_w, result_r)))
+        try:
+            process.start()
+        finally:
+            os.close(task_r)
+            os.close(result_w)
+        return _Worker(process, task_w, result_r)
+
+    def _worker_main(self, task_fd, result_fd, master_fds):
+        for fd in master_fds:  # fork 时继承了 master 一端和其他 worker 的管道, 不关掉的话读不到 EOF
+            os.close(fd)
+        for worker in self._workers:
+            worker.close()
+        if self._initializer is not None:
+            self._initializer(*self._initargs)
+        completed = 0
+        while self._maxtasks is None or completed < self._maxtasks:
+            message = _read_message(task_fd)
+            if message is None:  # master 关闭了管道
+                break
+            func, items = message
+            try:
+                result = (True, [func(item) for item in items])
+            except Exception as error:
+                result = (False, error)
+            try:
+                _write_message(result_fd, result)
+            except Exception as error:  # 结果或者异常不能 pickle
+                _write_message(result_fd, (False, RuntimeError('cannot send result: %r' % error)))
+            completed += 1
+
+    def _check_running(self):
+        if self._state != 'run':
+            raise ValueError('Pool not running')
+
+    def _chunksize(self, iterable, chunksize):
+        """和 multiprocessing 一样, 大约分成 worker 数 x 4 个批次; 不知道长度时每批一个"""
+        if chunksize is not None:
+            if chunksize < 1:
+                raise ValueError('chunksize must be at least 1')
+            return chunksize
+        try:
+            size = len(iterable)
+        except TypeError:
+            return 1
+        chunksize, extra = divmod(size, self._processes * 4)
+        return max(1, chunksize + bool(extra))
+
+    def _next_task(self):
+        if self._pending:
+            return self._pending.popleft()
+        for feeder in self._feeders:
+            task = feeder.next_task()
+            if task is not None:
+                return task
+        self._feeders = [feeder for feeder in self._feeders if not feeder.exhausted]
+        return None
+
+    def _dispatch(self):
+        for worker in self._workers:
+            if worker.handler is not None:
+                continue
+            task = self._next_task()
+            if task is None:
+                return
+            func, items, handler = task
+            try:
+                _write_message(worker.task_fd, (func, items))
+            except (pickle.PicklingError, TypeError, AttributeError) as error:
+                handler(False, error)
+                continue
+            except OSError as error:  # worker 已经退出, 任务放回去, 等 _reap 替换它
+                if error.errno != errno.EPIPE:
+                    raise
+                self._pending.appendleft(task)
+                continue
+            worker.handler = handler
+
+    def _replace(self, worker, error=None):
+        """回收退出的 worker, 它手上的批次以 error 结束, 池还在运行时补一个新的"""
+        worker.process.join(1)
+        if worker.process.is_alive():
+            worker.process.kill()
+            worker.process.join()
+        if worker.handler is not None and worker.result_fd is not None:
+            # 进程退出前可能已经发出了结果(比如到了 maxtasksperchild), 先把管道里剩下的读出来
+            readable, _, _ = select.select([worker.result_fd], [], [], 0)
+            message = _read_message(worker.result_fd) if readable else None
+            if message is not None:
+                self._deliver(worker, message)
+        worker.close()
+        handler, worker.handler = worker.handler, None
+        if handler is not None:
+            handler(False, error or RuntimeError(
+                'worker %s exited with code %s' % (worker.process.pid, worker.process.exitcode)))
+        index = self._workers.index(worker)
+        if self._state == 'terminate':
+            del self._workers[index]
+        else:
+            self._workers[index] = self._spawn()
+
+    @staticmethod
+    def _deliver(worker, message):
+        handler, worker.handler = worker.handler, None
+        worker.tasks += 1
+        if handler is not None:
+            handler(*message)
+
+    def _pump(self, timeout=None):
+        """调度一轮: 发任务, 最多等 timeout 秒收结果, 回收和替换 worker"""
+        self._dispatch()
+        workers = {worker.result_fd: worker for worker in self._workers}
+        if not workers:
+            return
+        try:
+            readable, _, _ = select.select(list(workers), [], [], timeout)
+        except InterruptedError:
+            readable = []
+        for fd in readable:
+            worker = workers[fd]
+            message = _read_message(fd)
+            if message is None:  # worker 退出了
+                self._replace(worker)
+                continue
+            self._deliver(worker, message)
+            if self._maxtasks is not None and worker.tasks >= self._maxtasks:
+                self._replace(worker)  # worker 发完最后一个结果就自己退出了
+        for worker in list(self._workers):  # 没有读到 EOF 但已经退出的, 比如管道还被其他进程持有
+            if worker in self._workers and worker.process.exitcode is not None:
+                self._replace(worker)
+        self._dispatch()
+
+    def apply_async(self, func, args=(), kwds={}, callback=None, error_callback=None):
+        self._check_running()
+        result = AsyncResult(self, callback, error_callback)
+        self._pending.append((_call, [(func, tuple(args), dict(kwds))],
+                              lambda success, value: result._set(success, value[0] if success else value)))
+        self._dispatch()
+        return result
+
+    def apply(self, func, args=(), kwds={}):
+        return self.apply_async(func, args, kwds).get()
+
+    def map_async(self, func, iterable, chunksize=None, callback=None, error_callback=None):
+        self._check_running()
+        items = list(iterable)
+        chunksize = self._chunksize(items, chunksize)
+        result = AsyncResult(self, callback, error_callback)
+        values = [None] * len(items)
+        remaining = [len(range(0, len(items), chunksize))]
+
+        def done(start, success, value):
+            if result.ready():  # 已经有批次失败了
+                return
+            if not success:
+                result._set(False, value)
+                return
+            values[start:start + len(value)] = value
+            remaining[0] -= 1
+            if not remaining[0]:
+                result._set(True, values)
+
+        if not items:
+            result._set(True, values)
+        for start in range(0, len(items), chunksize):
+            self._pending.append((func, items[start:start + chunksize],
+                                  lambda success, value, start=start: done(start, success, value)))
+        self._dispatch()
+        return result
+
+    def map(self, func, iterable, chunksize=None):
+        return self.map_async(func, iterable, chunksize).get()
+
+    def imap(self, func, iterable, chunksize=None):
+        """按输入的顺序返回结果的迭代器, 输入是按需读取的"""
+        return self._imap(func, iterable, chunksize, True)
+
+    def imap_unordered(self, func, iterable, chunksize=None):
+        """批次按完成的顺序返回"""
+        return self._imap(func, iterable, chunksize, False)
+
+    def _imap(self, func, iterable, chunksize, ordered):
+        self._check_running()
+        feeder = _Feeder(func, iterable, self._chunksize(iterable, chunksize))
+        self._feeders.append(feeder)
+        self._dispatch()
+        return self._iter_results(feeder, ordered)
+
+    def _iter_results(self, feeder, ordered):
+        results = feeder.results
+        received = 0
+        try:
+            while True:
+                if ordered:
+                    key = received if received in results else None
+                else:
+                    key = next(iter(results), None)
+                if key is not None:
+                    success, values = results.pop(key)
+                    received += 1
+                    if not success:
+                        raise values
+                    yield from values
+                elif feeder.exhausted and received == feeder.sent:
+                    return
+                else:
+                    self._pump()
+        finally:
+            if feeder in self._feeders:  # 提前停止迭代, 不再发剩下的批次
+                self._feeders.remove(feeder)
+
+    def close(self):
+        """不再接受新任务, 之后调用 join() 等已经提交的任务完成"""
+        if self._state == 'run':
+            self._state = 'close'
+
+    def join(self):
+        if self._state == 'run':
+            raise ValueError('Pool is still running, call close() or terminate() first')
+        while self._state == 'close' and (
+                self._pending or self._feeders or any(worker.handler for worker in self._workers)):
+            self._pump()
+        for worker in self._workers:  # 关闭任务管道, worker 读到 EOF 后退出
+            worker.close_tasks()
+        for worker in self._workers:
+            worker.process.join()
+            worker.close()
+        self._workers = []
+
+    def terminate(self):
+        """立即杀掉所有 worker, 没有完成的任务以异常结束"""
+        self._state = 'terminate'
+        self._pending.clear()
+        self._feeders = []
+        for worker in self._workers:
+            worker.process.terminate()
+        for worker in list(self._workers):
+            self._replace(worker, RuntimeError('Pool was terminated'))
+
+    def __enter__(self):
+        self._check_running()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.terminate()
+
+
 if __name__ == '__main__':
     p = Process()
     p.start()
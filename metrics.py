@@ -0,0 +1,261 @@
+"""
+简易的监控指标, mark01/mark02/mark03 共用
+1.Counter/Gauge/Histogram 三种指标, 都可以带标签, 线程安全
+2.render() 输出 Prometheus 文本格式, metrics_app/MetricsEndpoint/metrics_view 把它暴露成 /metrics
+3.add_hook 注册回调, 每次记录指标时调用 hook(metric, value, labels), 可以转发到 statsd 之类的系统
+4.逐个请求的调试输出按 DEBUG_SAMPLE_RATE 采样, 默认关闭
+"""
+
+import time
+import random
+import bisect
+import threading
+
+
+ENABLED = True  # 关闭后各处不再记录指标
+DEBUG_SAMPLE_RATE = 0.0  # 打印请求/响应调试信息的比例, 0 表示不打印
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def set_enabled(enabled):
+    global ENABLED
+    ENABLED = bool(enabled)
+
+
+def set_debug_sample_rate(rate):
+    global DEBUG_SAMPLE_RATE
+    DEBUG_SAMPLE_RATE = max(0.0, min(1.0, float(rate)))
+
+
+def sample_debug():
+    """这个请求要不要输出调试信息"""
+    return DEBUG_SAMPLE_RATE > 0 and random.random() < DEBUG_SAMPLE_RATE
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                          .replace('\n', '\\n')) for name, value in items)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation='', registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.registry = registry
+        self._values = {}  # {排好序的标签元组: 值}
+        self._lock = threading.Lock()
+
+    def _notify(self, value, labels):
+        if self.registry is not None and self.registry.hooks:
+            self.registry.notify(self, value, labels)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """[(后缀, 标签元组, 值)]"""
+        with self._lock:
+            return [('', key, value) for key, value in self._values.items()]
+
+    def get(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, key, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, _format_labels(key), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self._notify(amount, labels)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+        self._notify(value, labels)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            value = self._values[key] = self._values.get(key, 0) + amount
+        self._notify(value, labels)
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation='', registry=None, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:  # [每个桶的计数(非累计)..., +Inf 桶, 总和]
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+        self._notify(value, labels)
+
+    def get(self, **labels):
+        """返回 (次数, 总和)"""
+        state = self._values.get(tuple(sorted(labels.items())))
+        if state is None:
+            return 0, 0.0
+        return sum(state[:-1]), state[-1]
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        samples = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state[:-1]):
+                cumulative += count
+                samples.append(('_bucket', key + (('le', _format_value(float(bound))),), cumulative))
+            samples.append(('_sum', key, state[-1]))
+            samples.append(('_count', key, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, documentation, self, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('metric %s already registered as %s' % (name, metric.type))
+            return metric
+
+    def counter(self, name, documentation=''):
+        return self._get_or_create(Counter, name, documentation)
+
+    def gauge(self, name, documentation=''):
+        return self._get_or_create(Gauge, name, documentation)
+
+    def histogram(self, name, documentation='', buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, buckets=buckets)
+
+    def add_hook(self, hook):
+        """hook(metric, value, labels), 在记录指标的线程中同步调用, 应当尽快返回"""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def notify(self, metric, value, labels):
+        for hook in list(self.hooks):
+            try:
+                hook(metric, value, labels)
+            except Exception:
+                pass  # 监控回调出错不能影响请求处理
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in list(self.metrics.values())) + '\n'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+add_hook = REGISTRY.add_hook
+remove_hook = REGISTRY.remove_hook
+render = REGISTRY.render
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# 各模块共用的指标
+IOLOOP_LAG = histogram('mark_ioloop_lag_seconds', 'How late IOLoop timers fire')
+IOLOOP_ITERATION = histogram('mark_ioloop_iteration_seconds', 'Time an IOLoop iteration spends outside select')
+IOLOOP_CALLBACK = histogram('mark_ioloop_callback_seconds', 'Time spent in each IOLoop callback')
+IOLOOP_SELECT = histogram('mark_ioloop_select_seconds', 'Time the IOLoop spends waiting in select')
+CONNECTIONS_ACTIVE = gauge('mark_connections_active', 'Currently open client connections')
+CONNECTIONS_TOTAL = counter('mark_connections_total', 'Accepted client connections')
+REQUESTS_TOTAL = counter('mark_requests_total', 'Finished requests by status code')
+REQUEST_DURATION = histogram('mark_request_duration_seconds', 'Time to produce a response, per route')
+MIDDLEWARE_DURATION = histogram('mark_middleware_duration_seconds',
+                                'Time spent in a middleware and everything inside it')
+
+
+def timed_handler(handler, name, is_async=False):
+    """包一层中间件链上的 handler, 记录它(包括内层)的耗时"""
+    if is_async:
+        async def async_timed(request):
+            start = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                MIDDLEWARE_DURATION.observe(time.perf_counter() - start, middleware=name)
+        return async_timed
+
+    def timed(request):
+        start = time.perf_counter()
+        try:
+            return handler(request)
+        finally:
+            MIDDLEWARE_DURATION.observe(time.perf_counter() - start, middleware=name)
+    return timed
+
+
+def metrics_app(environ, start_response):
+    """输出 Prometheus 文本格式的 WSGI 应用"""
+    body = render().encode('utf-8')
+    start_response('200 OK', [('Content-Type', CONTENT_TYPE), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+class MetricsEndpoint:
+    """包在任意 WSGI 应用外面, path 的请求返回指标, 其他请求交给 application"""
+    def __init__(self, application, path='/metrics'):
+        self.application = application
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == self.path:
+            return metrics_app(environ, start_response)
+        return self.application(environ, start_response)
+
+
+def metrics_view(request):
+    """mark01 的 view, 加到 urlpatterns 中: (r'^/metrics$', metrics.metrics_view, ['GET'])"""
+    from mark01 import HttpResponse
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,140 @@
+"""
+响应缓存中间件
+1.view 用 cache_page(timeout) 装饰后才会缓存, 也可以给 CacheMiddleware.default_timeout 设置全局过期时间
+2.缓存 key 由 method, path, query string 和 key_headers 中的请求头组成
+3.缓存渲染好的 body bytes, 按条目数和总字节数做 LRU 淘汰, 每个条目有自己的 TTL
+4.带 If-None-Match / If-Modified-Since 的条件 GET 命中时直接返回 304, 不调用 view
+5.设置了 Set-Cookie 的响应不缓存; 带 Cookie/Authorization 的请求不走缓存, 除非 view 在 vary_headers 中声明了它们
+"""
+import hashlib
+from email.utils import formatdate, parsedate_to_datetime
+
+from mark01 import HttpResponse, LRUCache
+
+
+def cache_page(timeout, vary_headers=()):
+    """view 装饰器: 打开该 view 的响应缓存, timeout 为过期秒数, vary_headers 为额外参与 key 的请求头"""
+    def decorator(view):
+        view.cache_timeout = timeout
+        view.cache_vary_headers = tuple(header.lower() for header in vary_headers)
+        return view
+    return decorator
+
+
+class CacheEntry:
+    __slots__ = ('status_code', 'headers', 'content', 'etag', 'last_modified')
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = list(response.items())
+        self.content = response.content
+        self.etag = response['ETag']
+        self.last_modified = response['Last-Modified']
+
+    def to_response(self):
+        response = HttpResponse(self.content, status=self.status_code)
+        for header, value in self.headers:
+            response[header] = value
+        return response
+
+
+class CacheMiddleware:
+    max_entries = 1024
+    max_bytes = 64 * 1024 * 1024
+    default_timeout = None  # None 表示只缓存 cache_page 标记过的 view
+    cacheable_methods = ('GET', 'HEAD')
+    key_headers = ('accept',)  # 所有缓存 key 都会带上的请求头
+    credential_headers = ('cookie', 'authorization')  # 带这些请求头的响应可能因人而异
+
+    def __init__(self):
+        self.cache = LRUCache(self.max_entries, self.max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.cache),
+            'bytes': self.cache.total_size,
+        }
+
+    def get_cache_key(self, request, vary_headers=()):
+        headers = request.headers
+        return (
+            request.method,
+            request.path,
+            request.META.get('QUERY_STRING', ''),
+            tuple(headers.get(header, '') for header in self.key_headers + vary_headers),
+        )
+
+    def process_view(self, request, view, kwargs):
+        timeout = getattr(view, 'cache_timeout', self.default_timeout)
+        if not timeout or request.method not in self.cacheable_methods:
+            return None
+        vary_headers = getattr(view, 'cache_vary_headers', ())
+        if any(request.headers.get(header) and header not in vary_headers for header in self.credential_headers):
+            return None
+        request._cache_key = key = self.get_cache_key(request, vary_headers)
+        request._cache_timeout = timeout
+        request._cache_vary_headers = vary_headers
+
+        entry = self.cache.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        request._cache_hit = True
+        if self.not_modified(request, entry.etag, entry.last_modified):
+            return self.not_modified_response(entry.etag, entry.last_modified)
+        return entry.to_response()
+
+    def process_response(self, request, response):
+        key = getattr(request, '_cache_key', None)
+        if key is None or getattr(request, '_cache_hit', False):
+            return response
+        if response.streaming or response.status_code != 200 or response.has_header('Set-Cookie'):
+            return response
+        cache_control = response.get('Cache-Control', '')
+        if 'no-store' in cache_control or 'private' in cache_control:
+            return response
+
+        timeout = request._cache_timeout
+        if not response.has_header('ETag'):
+            response['ETag'] = '"%s"' % hashlib.md5(response.content).hexdigest()
+        if not response.has_header('Last-Modified'):
+            response['Last-Modified'] = formatdate(usegmt=True)
+        if not cache_control:
+            response['Cache-Control'] = 'max-age=%d' % timeout
+        vary_headers = self.key_headers + request._cache_vary_headers
+        if vary_headers:
+            response['Vary'] = ', '.join(header.title() for header in vary_headers)
+        self.cache.set(key, CacheEntry(response), timeout, len(response.content))
+
+        if self.not_modified(request, response['ETag'], response['Last-Modified']):
+            return self.not_modified_response(response['ETag'], response['Last-Modified'])
+        return response
+
+    @staticmethod
+    def not_modified(request, etag, last_modified):
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:  # 有 If-None-Match 时忽略 If-Modified-Since
+            if if_none_match.strip() == '*':
+                return True
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return etag in tags or 'W/' + etag in tags
+        if_modified_since = request.headers.get('If-Modified-Since')
+        if if_modified_since is not None and last_modified:
+            try:
+                return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    @staticmethod
+    def not_modified_response(etag, last_modified):
+        response = HttpResponse(status=304)
+        del response['Content-Type']
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        return response
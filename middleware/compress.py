@@ -0,0 +1,130 @@
+"""
+压缩中间件
+1.根据 Accept-Encoding 选择 gzip 或 deflate, body 小于 min_length 的不压缩
+2.带 ETag 的响应(比如 CacheMiddleware 缓存过的)把压缩结果缓存起来, 同样的内容不会重复压缩
+3.流式响应逐块压缩, 不会把整个 body 缓冲在内存里
+放在 middleware 列表中 CacheMiddleware 之前, 缓存里存的是未压缩的内容
+"""
+import re
+import zlib
+from functools import lru_cache
+
+from mark01 import LRUCache
+
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+_accept_encoding_re = re.compile(r'^\s*([^\s;]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*$')
+
+
+@lru_cache(maxsize=256)
+def parse_accept_encoding(header):
+    """'gzip;q=0.8, deflate' -> {'gzip': 0.8, 'deflate': 1.0}"""
+    result = {}
+    for item in header.split(','):
+        matched = _accept_encoding_re.match(item)
+        if not matched:
+            continue
+        try:
+            quality = float(matched.group(2)) if matched.group(2) else 1.0
+        except ValueError:
+            continue
+        result[matched.group(1).lower()] = quality
+    return result
+
+
+class CompressionMiddleware:
+    min_length = 200
+    compress_level = 6
+    encodings = ('gzip', 'deflate')  # 服务端偏好顺序
+    compressible_types = ('text/', 'application/json', 'application/javascript',
+                          'application/xml', '+json', '+xml')
+    cache_entries = 512
+    cache_bytes = 32 * 1024 * 1024
+
+    def __init__(self):
+        self.cache = LRUCache(self.cache_entries, self.cache_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.cache),
+            'bytes': self.cache.total_size,
+        }
+
+    def select_encoding(self, accept_encoding):
+        accepted = parse_accept_encoding(accept_encoding)
+        best, best_quality = None, 0
+        for encoding in self.encodings:
+            quality = accepted.get(encoding, accepted.get('*', 0))
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def is_compressible(self, response):
+        if response.status_code < 200 or response.status_code in (204, 206, 304):
+            return False
+        if response.has_header('Content-Encoding'):
+            return False
+        content_type = response.get('Content-Type', '').split(';', 1)[0].strip().lower()
+        return any(content_type.startswith(t) if t.endswith('/') else
+                   (content_type == t or content_type.endswith(t)) for t in self.compressible_types)
+
+    def process_response(self, request, response):
+        if not self.is_compressible(response):
+            return response
+        encoding = self.select_encoding(request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            response.streaming_content = self.compress_stream(response.streaming_content, encoding)
+            response.file_to_stream = None  # 压缩后不能再交给 wsgi.file_wrapper 直接发送文件
+            del response['Content-Length']
+        else:
+            content = response.content
+            if len(content) < self.min_length:
+                return response
+            compressed = self.compress(content, encoding, response.get('ETag'))
+            if len(compressed) >= len(content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = len(compressed)
+
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):  # 压缩后字节不同, 只能作为弱 ETag
+            response['ETag'] = 'W/' + etag
+        vary = response.get('Vary')
+        if not vary:
+            response['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            response['Vary'] = vary + ', Accept-Encoding'
+        response['Content-Encoding'] = encoding
+        return response
+
+    def compress(self, content, encoding, etag=None):
+        if etag is None:
+            return self._compress(content, encoding)
+        key = (encoding, self.compress_level, etag, len(content))
+        compressed = self.cache.get(key)
+        if compressed is None:
+            self.misses += 1
+            compressed = self._compress(content, encoding)
+            self.cache.set(key, compressed, size=len(compressed))
+        else:
+            self.hits += 1
+        return compressed
+
+    def _compress(self, content, encoding):
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, WBITS[encoding])
+        return compressor.compress(content) + compressor.flush()
+
+    def compress_stream(self, chunks, encoding):
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, WBITS[encoding])
+        for chunk in chunks:
+            data = compressor.compress(chunk)  # zlib 内部攒够一块才有输出
+            if data:
+                yield data
+        yield compressor.flush()